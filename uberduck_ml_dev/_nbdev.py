@@ -5,6 +5,20 @@ __all__ = ["index", "modules", "custom_doc_links", "git_url"]
 index = {"insert_speaker": "data.cache.ipynb",
          "ensure_speaker_table": "data.cache.ipynb",
          "ensure_filelist_in_cache": "data.cache.ipynb",
+         "feature_store_key": "data.feature_store.ipynb",
+         "FeatureStoreWriter": "data.feature_store.ipynb",
+         "FeatureStore": "data.feature_store.ipynb",
+         "FEATURE_STORE_VERSION": "data.feature_store.ipynb",
+         "DEFAULT_SHARD_SIZE": "data.feature_store.ipynb",
+         "SpectrogramCache": "data.feature_store.ipynb",
+         "read_wav_header": "data.manifest.ipynb",
+         "WavManifest": "data.manifest.ipynb",
+         "WavInfo": "data.manifest.ipynb",
+         "ShardWriter": "data.shards.ipynb",
+         "iter_shard": "data.shards.ipynb",
+         "ShardedDataset": "data.shards.ipynb",
+         "SHARDS_VERSION": "data.shards.ipynb",
+         "SHARD_INDEX": "data.shards.ipynb",
          "word_frequencies": "data.statistics.ipynb",
          "create_wordcloud": "data.statistics.ipynb",
          "count_frequency": "data.statistics.ipynb",
@@ -13,21 +27,28 @@ index = {"insert_speaker": "data.cache.ipynb",
          "get_sample_format": "data.statistics.ipynb",
          "AbsoluteMetrics": "data.statistics.ipynb",
          "oversample": "data_loader.ipynb",
+         "sample_weights": "data_loader.ipynb",
          "TextMelDataset": "data_loader.ipynb",
          "TextMelCollate": "data_loader.ipynb",
+         "FrameBudgetBatchSampler": "data_loader.ipynb",
          "TextAudioSpeakerLoader": "data_loader.ipynb",
          "TextAudioSpeakerCollate": "data_loader.ipynb",
+         "bucket_boundaries": "data_loader.ipynb",
          "DistributedBucketSampler": "data_loader.ipynb",
+         "WeightedDistributedSampler": "data_loader.ipynb",
+         "parse_args": "exec.train_vits.ipynb",
+         "build_feature_store": "exec.build_feature_store.ipynb",
+         "build_manifest": "exec.build_manifest.ipynb",
          "get_summary_statistics": "exec.dataset_statistics.ipynb",
          "calculate_statistics": "exec.dataset_statistics.ipynb",
          "generate_markdown": "exec.dataset_statistics.ipynb",
-         "parse_args": "exec.train_vits.ipynb",
          "run": "exec.train_vits.ipynb",
          "CACHE_LOCATION": "exec.select_speakers.ipynb",
          "STANDARD_MULTISPEAKER": "exec.generate_filelist.ipynb",
          "STANDARD_SINGLESPEAKER": "exec.generate_filelist.ipynb",
          "VCTK": "exec.generate_filelist.ipynb",
          "FORMATS": "exec.generate_filelist.ipynb",
+         "pack_shards": "exec.pack_shards.ipynb",
          "batch": "exec.preprocess_vits.ipynb",
          "flatten": "exec.preprocess_vits.ipynb",
          "Filelist": "exec.select_speakers.ipynb",
@@ -43,7 +64,12 @@ index = {"insert_speaker": "data.cache.ipynb",
          "LocationLayer": "models.common.ipynb",
          "Attention": "models.common.ipynb",
          "STFT": "models.common.ipynb",
+         "STFT_BACKENDS": "models.common.ipynb",
+         "mel_bands": "models.common.ipynb",
          "MelSTFT": "models.common.ipynb",
+         "StreamingMelSTFT": "models.common.ipynb",
+         "get_stft": "models.common.ipynb",
+         "get_mel_stft": "models.common.ipynb",
          "ReferenceEncoder": "models.common.ipynb",
          "STL": "models.common.ipynb",
          "GST": "models.common.ipynb",
@@ -94,6 +120,11 @@ index = {"insert_speaker": "data.cache.ipynb",
          "id_to_symbol": "text.symbols.ipynb",
          "curly_re": "text.symbols.ipynb",
          "words_re": "text.symbols.ipynb",
+         "token_cache_key": "text.token_cache.ipynb",
+         "TokenCache": "text.token_cache.ipynb",
+         "TOKEN_CACHE_VERSION": "text.token_cache.ipynb",
+         "G2PCache": "text.util.ipynb",
+         "set_g2p_cache": "text.util.ipynb",
          "normalize_numbers": "text.util.ipynb",
          "expand_abbreviations": "text.util.ipynb",
          "expand_numbers": "text.util.ipynb",
@@ -107,10 +138,13 @@ index = {"insert_speaker": "data.cache.ipynb",
          "english_cleaners_phonemizer": "text.util.ipynb",
          "batch_english_cleaners_phonemizer": "text.util.ipynb",
          "g2p": "text.util.ipynb",
+         "G2P_CACHE_LOCATION": "text.util.ipynb",
+         "g2p_cache": "text.util.ipynb",
          "batch_clean_text": "text.util.ipynb",
          "clean_text": "text.util.ipynb",
          "english_to_arpabet": "text.util.ipynb",
          "cleaned_text_to_sequence": "text.util.ipynb",
+         "text_to_words": "text.util.ipynb",
          "text_to_sequence": "text.util.ipynb",
          "sequence_to_text": "text.util.ipynb",
          "BATCH_CLEANERS": "text.util.ipynb",
@@ -129,6 +163,7 @@ index = {"insert_speaker": "data.cache.ipynb",
          "differenceFunction": "utils.audio.ipynb",
          "cumulativeMeanNormalizedDifferenceFunction": "utils.audio.ipynb",
          "getPitch": "utils.audio.ipynb",
+         "batch_compute_yin": "utils.audio.ipynb",
          "compute_yin": "utils.audio.ipynb",
          "convert_to_wav": "utils.audio.ipynb",
          "match_target_amplitude": "utils.audio.ipynb",
@@ -137,11 +172,14 @@ index = {"insert_speaker": "data.cache.ipynb",
          "normalize_audio": "utils.audio.ipynb",
          "trim_audio": "utils.audio.ipynb",
          "MAX_WAV_INT16": "utils.audio.ipynb",
+         "read_wav": "utils.audio.ipynb",
          "load_wav_to_torch": "utils.audio.ipynb",
+         "iter_wav_blocks": "utils.audio.ipynb",
          "save_figure_to_numpy": "utils.plot.ipynb",
          "plot_spectrogram": "utils.plot.ipynb",
          "plot_attention": "utils.plot.ipynb",
          "plot_gate_outputs": "utils.plot.ipynb",
+         "ColumnarFilelist": "utils.utils.ipynb",
          "load_filepaths_and_text": "utils.utils.ipynb",
          "synthesize_speakerids2": "utils.utils.ipynb",
          "parse_vctk": "utils.utils.ipynb",
@@ -163,6 +201,7 @@ index = {"insert_speaker": "data.cache.ipynb",
          "generate_path": "utils.utils.ipynb",
          "slice_segments": "utils.utils.ipynb",
          "rand_slice_segments": "utils.utils.ipynb",
+         "slice_ragged_segments": "utils.utils.ipynb",
          "init_weights": "utils.utils.ipynb",
          "get_padding": "utils.utils.ipynb",
          "fused_add_tanh_sigmoid_multiply": "utils.utils.ipynb",
@@ -173,11 +212,17 @@ index = {"insert_speaker": "data.cache.ipynb",
          "PARAM_RE": "vendor.tfcompat.hparam.ipynb"}
 
 modules = ["data/cache.py",
+           "data/feature_store.py",
+           "data/manifest.py",
+           "data/shards.py",
            "data/statistics.py",
            "data_loader.py",
+           "exec/build_feature_store.py",
+           "exec/build_manifest.py",
            "exec/dataset_statistics.py",
            "exec/generate_filelist.py",
            "exec/normalize_audio.py",
+           "exec/pack_shards.py",
            "exec/preprocess_vits.py",
            "exec/select_speakers.py",
            "exec/split_train_val.py",
@@ -191,6 +236,7 @@ modules = ["data/cache.py",
            "models/vits.py",
            "text/cmudict.py",
            "text/symbols.py",
+           "text/token_cache.py",
            "text/util.py",
            "trainer/base.py",
            "trainer/vits.py",
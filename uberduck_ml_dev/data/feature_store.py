@@ -0,0 +1,373 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/data.feature_store.ipynb (unless otherwise specified).
+
+__all__ = ['feature_store_key', 'FeatureStoreWriter', 'FeatureStore', 'FEATURE_STORE_VERSION', 'DEFAULT_SHARD_SIZE',
+           'SpectrogramCache']
+
+# Cell
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+import numpy as np
+import torch
+
+FEATURE_STORE_VERSION = 1
+DEFAULT_SHARD_SIZE = 2 ** 30  # bytes
+
+_INDEX_DTYPE = np.dtype(
+    [
+        ("shard", np.int32),
+        ("mel_offset", np.int64),
+        ("n_frames", np.int32),
+        ("f0_offset", np.int64),
+        ("f0_length", np.int32),
+        ("text_offset", np.int64),
+        ("text_length", np.int32),
+    ]
+)
+
+
+def feature_store_key(config: dict):
+    """Return a short, stable hash of the feature config."""
+    config = dict(config, version=FEATURE_STORE_VERSION)
+    serialized = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()[:16]
+
+
+def _shard_name(kind, idx):
+    return f"{kind}-{idx:05d}.bin"
+
+
+class FeatureStoreWriter:
+    """Append features to a new store.
+
+    Features are written to a temporary directory which is moved into place
+    by `close`, so readers never see a partially written store.
+    """
+
+    def __init__(
+        self,
+        root,
+        config: dict,
+        n_mel_channels: int,
+        include_f0: bool = False,
+        include_text: bool = False,
+        shard_size: int = DEFAULT_SHARD_SIZE,
+    ):
+        self.root = Path(root)
+        self.config = config
+        self.key = feature_store_key(config)
+        self.n_mel_channels = n_mel_channels
+        self.include_f0 = include_f0
+        self.include_text = include_text
+        self.shard_size = shard_size
+        self.path = self.root / self.key
+        self.tmp_path = self.root / f".{self.key}.tmp-{uuid.uuid4().hex[:8]}"
+        os.makedirs(self.tmp_path)
+
+        self.paths = []
+        self.index = []
+        self.shard_idx = -1
+        self._mel_file = None
+        self._f0_file = None
+        self._text_file = open(self.tmp_path / "text.bin", "wb")
+        self._text_offset = 0
+        self._open_shard()
+
+    def _open_shard(self):
+        self._close_shard()
+        self.shard_idx += 1
+        self._mel_file = open(self.tmp_path / _shard_name("mel", self.shard_idx), "wb")
+        if self.include_f0:
+            self._f0_file = open(
+                self.tmp_path / _shard_name("f0", self.shard_idx), "wb"
+            )
+        self._mel_offset = 0
+        self._f0_offset = 0
+
+    def _close_shard(self):
+        if self._mel_file is not None:
+            self._mel_file.close()
+        if self._f0_file is not None:
+            self._f0_file.close()
+
+    def add(self, path: str, mel, f0=None, text=None):
+        """Add features for one audio file.
+
+        mel: (n_mel_channels, T) tensor or array.
+        f0: (1, T_f0) or (T_f0,) tensor or array, required if include_f0.
+        text: 1-d sequence of symbol ids, required if include_text.
+        """
+        mel = np.ascontiguousarray(np.asarray(mel, dtype=np.float32))
+        assert mel.ndim == 2 and mel.shape[0] == self.n_mel_channels, mel.shape
+        n_frames = mel.shape[1]
+        shard_bytes = (self._mel_offset * self.n_mel_channels + mel.size) * 4
+        if self._mel_offset and shard_bytes > self.shard_size:
+            self._open_shard()
+        self._mel_file.write(mel.tobytes())
+        mel_offset = self._mel_offset
+        self._mel_offset += n_frames
+
+        f0_offset, f0_length = 0, 0
+        if self.include_f0:
+            f0 = np.ascontiguousarray(np.asarray(f0, dtype=np.float32).reshape(-1))
+            self._f0_file.write(f0.tobytes())
+            f0_offset, f0_length = self._f0_offset, f0.size
+            self._f0_offset += f0.size
+
+        text_offset, text_length = 0, 0
+        if self.include_text:
+            text = np.asarray(text, dtype=np.int16)
+            self._text_file.write(text.tobytes())
+            text_offset, text_length = self._text_offset, text.size
+            self._text_offset += text.size
+
+        self.paths.append(path)
+        self.index.append(
+            (
+                self.shard_idx,
+                mel_offset,
+                n_frames,
+                f0_offset,
+                f0_length,
+                text_offset,
+                text_length,
+            )
+        )
+
+    def close(self):
+        self._close_shard()
+        self._text_file.close()
+        np.save(self.tmp_path / "index.npy", np.array(self.index, dtype=_INDEX_DTYPE))
+        with open(self.tmp_path / "paths.txt", "w", encoding="utf-8") as f:
+            f.writelines([f"{p}\n" for p in self.paths])
+        with open(self.tmp_path / "meta.json", "w") as f:
+            json.dump(
+                dict(
+                    config=self.config,
+                    n_mel_channels=self.n_mel_channels,
+                    include_f0=self.include_f0,
+                    include_text=self.include_text,
+                    num_shards=self.shard_idx + 1,
+                    version=FEATURE_STORE_VERSION,
+                ),
+                f,
+                indent=4,
+                default=str,
+            )
+        if self.path.exists():
+            # Another process finished building the same store first.
+            shutil.rmtree(self.tmp_path)
+        else:
+            os.replace(self.tmp_path, self.path)
+        return self.path
+
+
+class FeatureStore:
+    """Read-only view over a store written by `FeatureStoreWriter`.
+
+    Shards are memory-mapped lazily, so the store can be created in the main
+    process and handed to forked or spawned dataloader workers.
+    """
+
+    def __init__(self, root, config: dict):
+        self.root = Path(root)
+        self.key = feature_store_key(config)
+        self.path = self.root / self.key
+        if not self.path.exists():
+            raise FileNotFoundError(f"No feature store found at {self.path}")
+        with open(self.path / "meta.json") as f:
+            meta = json.load(f)
+        self.n_mel_channels = meta["n_mel_channels"]
+        self.include_f0 = meta["include_f0"]
+        self.include_text = meta["include_text"]
+        self.num_shards = meta["num_shards"]
+        self.index = np.load(self.path / "index.npy", mmap_mode="r")
+        with open(self.path / "paths.txt", encoding="utf-8") as f:
+            self._path_to_row = {line.rstrip("\n"): i for i, line in enumerate(f)}
+        self._mel_shards = {}
+        self._f0_shards = {}
+        self._text = None
+
+    @staticmethod
+    def exists(root, config: dict):
+        return (Path(root) / feature_store_key(config) / "meta.json").exists()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_mel_shards"] = {}
+        state["_f0_shards"] = {}
+        state["_text"] = None
+        return state
+
+    def __len__(self):
+        return len(self._path_to_row)
+
+    def __contains__(self, path):
+        return path in self._path_to_row
+
+    def _mmap(self, cache, kind, shard, dtype):
+        if shard not in cache:
+            # NOTE: mode "c" gives writable, copy-on-write views so torch.from_numpy
+            # doesn't complain, while leaving the shard on disk untouched.
+            cache[shard] = np.memmap(
+                self.path / _shard_name(kind, shard), dtype=dtype, mode="c"
+            )
+        return cache[shard]
+
+    def n_frames(self, path):
+        return int(self.index[self._path_to_row[path]]["n_frames"])
+
+    def get(self, path):
+        """Return (mel, f0, text) for path. f0 and text are None if not stored."""
+        row = self.index[self._path_to_row[path]]
+        shard = int(row["shard"])
+        mel_shard = self._mmap(self._mel_shards, "mel", shard, np.float32)
+        start = int(row["mel_offset"]) * self.n_mel_channels
+        n_frames = int(row["n_frames"])
+        mel = mel_shard[start : start + n_frames * self.n_mel_channels]
+        mel = torch.from_numpy(mel).view(self.n_mel_channels, n_frames)
+
+        f0 = None
+        if self.include_f0:
+            f0_shard = self._mmap(self._f0_shards, "f0", shard, np.float32)
+            start = int(row["f0_offset"])
+            f0 = torch.from_numpy(f0_shard[start : start + int(row["f0_length"])])
+
+        text = None
+        if self.include_text:
+            if self._text is None:
+                self._text = np.memmap(self.path / "text.bin", dtype=np.int16, mode="c")
+            start = int(row["text_offset"])
+            text = self._text[start : start + int(row["text_length"])]
+            text = torch.from_numpy(text.astype(np.int64))
+        return mel, f0, text
+
+# Cell
+import glob
+
+
+class SpectrogramCache:
+    """Append-only cache of (n_channels, T) spectrograms keyed by audio path.
+
+    Safe to share between processes: each process writes its own
+    `spec-<pid>-<id>.bin` data file and `.idx` index file. The index is a
+    line of JSON per entry, appended after the data, so readers ignore
+    entries that are incomplete.
+    """
+
+    def __init__(self, root, config: dict, n_channels: int):
+        self.root = Path(root)
+        self.config = config
+        self.n_channels = n_channels
+        self.key = feature_store_key(config)
+        self.path = self.root / self.key
+        os.makedirs(self.path, exist_ok=True)
+        meta_path = self.path / "meta.json"
+        if not meta_path.exists():
+            tmp_path = self.path / f".meta.json.tmp-{uuid.uuid4().hex[:8]}"
+            with open(tmp_path, "w") as f:
+                json.dump(
+                    dict(
+                        config=config,
+                        n_channels=n_channels,
+                        version=FEATURE_STORE_VERSION,
+                    ),
+                    f,
+                    indent=4,
+                    default=str,
+                )
+            os.replace(tmp_path, meta_path)
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # path -> (shard name, offset in frames, n_frames)
+        self._index = {}
+        self._index_read = {}
+        self._shards = {}
+        self._data_fd = None
+        self._index_fd = None
+        self._data_offset = 0
+        self._shard = None
+        self.refresh()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        state["_data_fd"] = None
+        state["_index_fd"] = None
+        state["_shard"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def _check_pid(self):
+        # NOTE: forked dataloader workers inherit the parent's state
+        # without going through __setstate__.
+        if os.getpid() != self._pid:
+            self._reset()
+
+    def refresh(self):
+        """Pick up entries appended by other processes since the last refresh."""
+        for index_file in glob.glob(str(self.path / "*.idx")):
+            with open(index_file, "rb") as f:
+                f.seek(self._index_read.get(index_file, 0))
+                data = f.read()
+            end = data.rfind(b"\n") + 1
+            if not end:
+                continue
+            self._index_read[index_file] = self._index_read.get(index_file, 0) + end
+            for line in data[:end].splitlines():
+                shard, offset, n_frames, path = json.loads(line)
+                self._index[path] = (shard, offset, n_frames)
+
+    def __len__(self):
+        self._check_pid()
+        return len(self._index)
+
+    def __contains__(self, path):
+        self._check_pid()
+        return path in self._index
+
+    def get(self, path):
+        """Return the cached spectrogram for path, or None on a miss."""
+        self._check_pid()
+        if path not in self._index:
+            return None
+        shard, offset, n_frames = self._index[path]
+        start = offset * self.n_channels
+        end = start + n_frames * self.n_channels
+        mmap = self._shards.get(shard)
+        if mmap is None or mmap.size < end:
+            # NOTE: remap shards that have grown since they were mapped.
+            mmap = np.memmap(self.path / shard, dtype=np.float32, mode="c")
+            self._shards[shard] = mmap
+        return torch.from_numpy(mmap[start:end]).view(self.n_channels, n_frames)
+
+    def put(self, path, spec):
+        """Append spec for path. Another process may cache the same path; the
+        last entry read wins, and they are identical anyway."""
+        self._check_pid()
+        spec = np.ascontiguousarray(np.asarray(spec, dtype=np.float32))
+        assert spec.ndim == 2 and spec.shape[0] == self.n_channels, spec.shape
+        if self._data_fd is None:
+            name = f"spec-{self._pid}-{uuid.uuid4().hex[:8]}"
+            self._shard = f"{name}.bin"
+            flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+            self._data_fd = os.open(self.path / self._shard, flags, 0o644)
+            self._index_fd = os.open(self.path / f"{name}.idx", flags, 0o644)
+            self._data_offset = 0
+        data = spec.tobytes()
+        written = 0
+        while written < len(data):
+            written += os.write(self._data_fd, data[written:])
+        entry = (self._shard, self._data_offset, spec.shape[1], path)
+        os.write(self._index_fd, (json.dumps(entry) + "\n").encode("utf-8"))
+        self._index[path] = entry[:3]
+        self._data_offset += spec.shape[1]
\ No newline at end of file
@@ -0,0 +1,163 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/data.manifest.ipynb (unless otherwise specified).
+
+__all__ = ['read_wav_header', 'WavManifest', 'WavInfo']
+
+# Cell
+import os
+import struct
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import soundfile as sf
+
+WavInfo = namedtuple(
+    "WavInfo", ["sample_rate", "channels", "sample_width", "n_samples"]
+)
+
+_MANIFEST_DTYPE = np.dtype(
+    [
+        ("mtime_ns", np.int64),
+        ("size", np.int64),
+        ("sample_rate", np.int32),
+        ("channels", np.int16),
+        ("sample_width", np.int16),
+        ("n_samples", np.int64),
+    ]
+)
+
+_SUBTYPE_WIDTHS = {
+    "PCM_U8": 1,
+    "PCM_S8": 1,
+    "PCM_16": 2,
+    "PCM_24": 3,
+    "PCM_32": 4,
+    "FLOAT": 4,
+    "DOUBLE": 8,
+}
+
+
+def read_wav_header(path):
+    """Read a WavInfo from the RIFF header of path without reading the samples.
+
+    Files that aren't RIFF/WAVE (flac, ogg, ...) fall back to soundfile.
+    """
+    with open(path, "rb") as f:
+        riff = f.read(12)
+        if len(riff) == 12 and riff[:4] == b"RIFF" and riff[8:12] == b"WAVE":
+            fmt = None
+            while True:
+                chunk = f.read(8)
+                if len(chunk) < 8:
+                    break
+                chunk_id = chunk[:4]
+                (chunk_size,) = struct.unpack("<I", chunk[4:])
+                if chunk_id == b"fmt ":
+                    fmt = struct.unpack("<HHIIHH", f.read(16))
+                    f.seek(chunk_size - 16 + (chunk_size & 1), os.SEEK_CUR)
+                elif chunk_id == b"data":
+                    if fmt is None:
+                        raise ValueError(f"{path}: data chunk before fmt chunk")
+                    _, channels, sample_rate, _, block_align, bits = fmt
+                    # Streamed or truncated files can claim more data than
+                    # they have.
+                    remaining = os.fstat(f.fileno()).st_size - f.tell()
+                    n_samples = min(chunk_size, remaining) // block_align
+                    return WavInfo(sample_rate, channels, bits // 8, n_samples)
+                else:
+                    f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+            raise ValueError(f"{path}: no data chunk")
+    info = sf.info(path)
+    return WavInfo(
+        info.samplerate,
+        info.channels,
+        _SUBTYPE_WIDTHS.get(info.subtype, 0),
+        info.frames,
+    )
+
+
+def _stat(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+class WavManifest:
+    """Header-derived metadata for a set of audio files, saved at path.
+
+    `update` adds the given audio paths, reading headers in a thread pool.
+    With check_mtime, clips already in the manifest are stat-ed and re-read
+    if their mtime or size changed; without it, only missing clips are read,
+    so a dataset whose clips are all in the manifest touches no audio files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.paths = []
+        self.records = np.zeros(0, dtype=_MANIFEST_DTYPE)
+        if os.path.exists(path):
+            with np.load(path) as data:
+                self.paths = data["paths"].tolist()
+                self.records = data["records"]
+        self._index = {p: i for i, p in enumerate(self.paths)}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, audio_path):
+        return audio_path in self._index
+
+    def __getitem__(self, audio_path):
+        record = self.records[self._index[audio_path]]
+        return WavInfo(*(record[k].item() for k in WavInfo._fields))
+
+    def update(self, audio_paths, check_mtime=True, num_workers=16):
+        """Add or refresh audio_paths and save. Returns the number of clips read."""
+        audio_paths = list(dict.fromkeys(audio_paths))
+        with ThreadPoolExecutor(num_workers) as pool:
+            if check_mtime:
+                stats = list(pool.map(_stat, audio_paths))
+                stale = [
+                    (path, stat)
+                    for path, stat in zip(audio_paths, stats)
+                    if path not in self._index or self._stat_of(path) != stat
+                ]
+            else:
+                missing = [p for p in audio_paths if p not in self._index]
+                stale = list(zip(missing, pool.map(_stat, missing)))
+            headers = list(pool.map(read_wav_header, [p for p, _ in stale]))
+        if not stale:
+            return 0
+        new_records = []
+        for (path, stat), header in zip(stale, headers):
+            record = stat + tuple(header)
+            if path in self._index:
+                self.records[self._index[path]] = record
+            else:
+                self._index[path] = len(self.paths)
+                self.paths.append(path)
+                new_records.append(record)
+        self.records = np.concatenate(
+            [self.records, np.array(new_records, dtype=_MANIFEST_DTYPE)]
+        )
+        self.save()
+        return len(stale)
+
+    def _stat_of(self, audio_path):
+        record = self.records[self._index[audio_path]]
+        return int(record["mtime_ns"]), int(record["size"])
+
+    def save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, paths=np.array(self.paths, dtype=str), records=self.records)
+        # NOTE: every rank may build the same manifest, so write it
+        # atomically rather than risk a reader seeing half a file.
+        os.replace(tmp_path, self.path)
+
+    def lengths(self, audio_paths, hop_length, sampling_rate=None):
+        """Length in hops of each clip, after resampling to sampling_rate if given."""
+        records = self.records[[self._index[p] for p in audio_paths]]
+        n_samples = records["n_samples"]
+        if sampling_rate is not None:
+            n_samples = n_samples * sampling_rate // records["sample_rate"]
+        return n_samples // hop_length
\ No newline at end of file
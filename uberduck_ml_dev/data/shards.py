@@ -0,0 +1,228 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/data.shards.ipynb (unless otherwise specified).
+
+__all__ = ['ShardWriter', 'iter_shard', 'ShardedDataset', 'SHARDS_VERSION', 'SHARD_INDEX']
+
+# Cell
+import io
+import json
+import os
+import tarfile
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+from .feature_store import DEFAULT_SHARD_SIZE
+
+SHARDS_VERSION = 1
+SHARD_INDEX = "shards.json"
+
+
+def _npy_bytes(array):
+    buf = io.BytesIO()
+    np.save(buf, np.ascontiguousarray(array), allow_pickle=False)
+    return buf.getvalue()
+
+
+class ShardWriter:
+    """Pack clips into tar shards of about max_shard_size bytes under root.
+
+    features_key identifies the config the packed mels and f0s were computed
+    with (see feature_store_key), so readers with a different config know to
+    recompute them.
+    """
+
+    def __init__(self, root, max_shard_size=DEFAULT_SHARD_SIZE, features_key=None):
+        self.root = root
+        self.max_shard_size = max_shard_size
+        self.features_key = features_key
+        self.shards = []
+        self._tar = None
+        self._size = 0
+        self._count = 0
+        os.makedirs(root, exist_ok=True)
+
+    def _open_shard(self):
+        self._close_shard()
+        name = f"shard-{len(self.shards):05d}.tar"
+        self._tar = tarfile.open(os.path.join(self.root, name), "w")
+        self.shards.append(dict(name=name, n_samples=0))
+        self._size = 0
+
+    def _close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def _add_member(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self._tar.addfile(info, io.BytesIO(data))
+        self._size += len(data)
+
+    def add(self, path, text, sid, audio=None, mel=None, f0=None):
+        """Add a clip. audio defaults to the bytes of the file at path."""
+        if audio is None:
+            with open(path, "rb") as f:
+                audio = f.read()
+        if self._tar is None or self._size >= self.max_shard_size:
+            self._open_shard()
+        key = f"{self._count:09d}"
+        meta = dict(path=path, text=text, sid=sid)
+        self._add_member(f"{key}.json", json.dumps(meta).encode("utf-8"))
+        self._add_member(f"{key}.wav", audio)
+        if mel is not None:
+            self._add_member(f"{key}.mel.npy", _npy_bytes(mel))
+        if f0 is not None:
+            self._add_member(f"{key}.f0.npy", _npy_bytes(f0))
+        self.shards[-1]["n_samples"] += 1
+        self._count += 1
+
+    def close(self):
+        self._close_shard()
+        index = dict(
+            version=SHARDS_VERSION, features_key=self.features_key, shards=self.shards
+        )
+        with open(os.path.join(self.root, SHARD_INDEX), "w") as f:
+            json.dump(index, f)
+        return self.root
+
+
+def _decode_member(name, data):
+    if name.endswith(".json"):
+        return json.loads(data)
+    if name.endswith(".npy"):
+        return np.load(io.BytesIO(data), allow_pickle=False)
+    return data
+
+
+def iter_shard(path, features_key=None):
+    """Yield the samples in a shard, in order, reading it sequentially.
+
+    A sample is a dict with path, text, sid, audio (wav bytes), and mel and
+    f0 arrays if they were packed.
+    """
+    sample, sample_key = {}, None
+    with tarfile.open(path, "r|") as tar:
+        for member in tar:
+            key, suffix = member.name.split(".", 1)
+            if key != sample_key and sample:
+                yield sample
+                sample = {}
+            sample_key = key
+            value = _decode_member(member.name, tar.extractfile(member).read())
+            if suffix == "json":
+                sample.update(value, features_key=features_key)
+            elif suffix == "wav":
+                sample["audio"] = value
+            else:
+                sample[suffix[: -len(".npy")]] = value
+    if sample:
+        yield sample
+
+
+class ShardedDataset(IterableDataset):
+    """Stream samples from the shards in root, passed through decode.
+
+    Samples for which decode returns None are skipped. Each rank yields
+    len(self) samples per epoch, cycling through its shards again if they run
+    out, so ranks stay in step under DDP.
+    """
+
+    def __init__(
+        self,
+        root,
+        decode=None,
+        shuffle=True,
+        shuffle_buffer=1000,
+        seed=0,
+        num_replicas=None,
+        rank=None,
+    ):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_initialized() else 0
+        with open(os.path.join(root, SHARD_INDEX)) as f:
+            index = json.load(f)
+        self.root = root
+        self.shards = index["shards"]
+        self.features_key = index["features_key"]
+        self.decode = decode
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        if len(self.shards) < num_replicas:
+            raise ValueError(
+                f"{len(self.shards)} shards can't be split across {num_replicas} ranks"
+            )
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return sum(s["n_samples"] for s in self.shards) // self.num_replicas
+
+    def _worker_shards(self, worker_id, num_workers):
+        order = np.arange(len(self.shards))
+        if self.shuffle:
+            order = np.random.default_rng(self.seed + self.epoch).permutation(order)
+        shards = order[self.rank :: self.num_replicas][worker_id::num_workers]
+        if len(shards) == 0:
+            raise ValueError(
+                f"Not enough shards for {num_workers} workers on each of {self.num_replicas} ranks"
+            )
+        return [self.shards[i] for i in shards]
+
+    def _shuffled(self, samples, rng):
+        """Shuffle samples through a buffer of shuffle_buffer samples."""
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = rng.integers(len(buffer))
+            buffer[i], sample = sample, buffer[i]
+            yield sample
+        for i in rng.permutation(len(buffer)):
+            yield buffer[i]
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (
+            (0, 1) if worker is None else (worker.id, worker.num_workers)
+        )
+        # Split this rank's samples evenly across its workers.
+        num_samples = len(self) // num_workers + (worker_id < len(self) % num_workers)
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank, worker_id])
+        shards = self._worker_shards(worker_id, num_workers)
+        n_yielded = 0
+        while n_yielded < num_samples:
+            samples = (
+                sample
+                for shard in shards
+                for sample in iter_shard(
+                    os.path.join(self.root, shard["name"]), self.features_key
+                )
+            )
+            if self.shuffle:
+                samples = self._shuffled(samples, rng)
+            n_pass = 0
+            for sample in samples:
+                if self.decode is not None:
+                    sample = self.decode(sample)
+                    if sample is None:
+                        continue
+                yield sample
+                n_pass += 1
+                n_yielded += 1
+                if n_yielded == num_samples:
+                    return
+            if n_pass == 0:
+                raise ValueError(f"No samples in shards {shards}")
+            # Out of shards before the epoch is over: go around again.
+            if self.shuffle:
+                shards = [shards[i] for i in rng.permutation(len(shards))]
\ No newline at end of file
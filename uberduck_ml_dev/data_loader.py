@@ -1,9 +1,12 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/data_loader.ipynb (unless otherwise specified).
 
-__all__ = ['oversample', 'TextMelDataset', 'TextMelCollate', 'TextAudioSpeakerLoader', 'TextAudioSpeakerCollate',
-           'DistributedBucketSampler']
+__all__ = ['oversample', 'sample_weights', 'TextMelDataset', 'TextMelCollate', 'FrameBudgetBatchSampler',
+           'TextAudioSpeakerLoader', 'TextAudioSpeakerCollate', 'bucket_boundaries', 'DistributedBucketSampler',
+           'WeightedDistributedSampler']
 
 # Cell
+import hashlib
+import io
 import os
 import random
 import re
@@ -11,16 +14,30 @@ from pathlib import Path
 from typing import List
 
 import numpy as np
-from scipy.io.wavfile import read
 import torch
-from torch.utils.data import Dataset
+import torch.distributed as dist
+from torch.utils.data import Dataset, Sampler, get_worker_info
 from torch.utils.data.distributed import DistributedSampler
 
-from .models.common import STFT, MelSTFT
+from .data.feature_store import (
+    DEFAULT_SHARD_SIZE,
+    FeatureStore,
+    FeatureStoreWriter,
+    SpectrogramCache,
+    feature_store_key,
+)
+from .data.manifest import WavManifest
+from .data.shards import ShardWriter
+from .models.common import STFT, MelSTFT, get_mel_stft
 from .text.symbols import DEFAULT_SYMBOLS, IPA_SYMBOLS
+from .text.token_cache import TokenCache
 from .text.util import cleaned_text_to_sequence, text_to_sequence
 from .utils.audio import compute_yin, load_wav_to_torch
-from .utils.utils import load_filepaths_and_text, intersperse
+from .utils.utils import (
+    ColumnarFilelist,
+    load_filepaths_and_text,
+    intersperse,
+)
 
 # Cell
 from collections import defaultdict
@@ -28,6 +45,11 @@ from collections import defaultdict
 
 def oversample(filepaths_text_sid, sid_to_weight):
     assert all([isinstance(sid, str) for sid in sid_to_weight.keys()])
+    if isinstance(filepaths_text_sid, ColumnarFilelist):
+        weights = sample_weights(filepaths_text_sid, sid_to_weight)
+        return filepaths_text_sid.take(
+            _expand_by_weight(np.arange(len(filepaths_text_sid)), weights)
+        )
     output = []
     for fts in filepaths_text_sid:
         sid = fts[2]
@@ -35,9 +57,50 @@ def oversample(filepaths_text_sid, sid_to_weight):
             output.append(fts)
     return output
 
+
+def sample_weights(filepaths_text_sid, sid_to_weight):
+    """Per-row sampling weights for speakers in sid_to_weight.
+
+    The alternative to oversample for weighted samplers: every clip stays in the
+    dataset once, and the sampler draws it weight times per epoch on average.
+    """
+    assert all([isinstance(sid, str) for sid in sid_to_weight.keys()])
+    if (
+        isinstance(filepaths_text_sid, ColumnarFilelist)
+        and filepaths_text_sid.sids is not None
+    ):
+        sids = filepaths_text_sid.sids
+        weights = np.ones(len(sids))
+        for sid, weight in sid_to_weight.items():
+            if sid.isdigit():
+                weights[sids == int(sid)] = weight
+        return weights
+    return np.array(
+        [sid_to_weight.get(fts[2], 1) for fts in filepaths_text_sid], dtype=np.float64
+    )
+
+
+def _expand_by_weight(indices, weights):
+    """Repeat each index by its (rounded) weight, as oversample does for rows."""
+    if weights is None:
+        return indices
+    return np.repeat(indices, np.rint(weights[indices]).astype(np.int64))
+
 # Cell
 
 
+def _open_token_cache(root, transcripts, cleaner_names, include_arpabet=False):
+    # One cache per set of transcripts, so that the training and validation
+    # datasets each get a cache with all of their transcripts in it.
+    transcripts = sorted(set(transcripts))
+    digest = hashlib.sha1("\n".join(transcripts).encode("utf-8")).hexdigest()[:16]
+    root = os.path.join(root, digest)
+    if TokenCache.exists(root, cleaner_names, include_arpabet):
+        return TokenCache(root, cleaner_names, include_arpabet)
+    print(f"Building token cache in {root}")
+    return TokenCache.build(root, transcripts, cleaner_names, include_arpabet)
+
+
 def _orig_to_dense_speaker_id(speaker_ids):
     speaker_ids = sorted(list(set(speaker_ids)))
     return {orig: idx for orig, idx in zip(speaker_ids, range(len(speaker_ids)))}
@@ -65,16 +128,23 @@ class TextMelDataset(Dataset):
         debug: bool = False,
         debug_dataset_size: int = None,
         oversample_weights=None,
+        feature_store: str = None,
+        token_cache: str = None,
+        manifest: str = None,
+        stft_backend: str = "conv",
     ):
         super().__init__()
         path = audiopaths_and_text
         oversample_weights = oversample_weights or {}
-        self.audiopaths_and_text = oversample(
-            load_filepaths_and_text(path), oversample_weights
+        # NOTE: oversampling is done by samplers that read sample_weights,
+        # so each clip is only loaded once.
+        self.audiopaths_and_text = load_filepaths_and_text(path, columnar=True)
+        self.sample_weights = sample_weights(
+            self.audiopaths_and_text, oversample_weights
         )
         self.text_cleaners = text_cleaners
         self.p_arpabet = p_arpabet
-        self.stft = MelSTFT(
+        self.stft = get_mel_stft(
             filter_length=filter_length,
             hop_length=hop_length,
             win_length=win_length,
@@ -82,11 +152,15 @@ class TextMelDataset(Dataset):
             sampling_rate=sample_rate,
             mel_fmin=mel_fmin,
             mel_fmax=mel_fmax,
+            stft_backend=stft_backend,
         )
         self.max_wav_value = max_wav_value
+        self._wav_buffer = torch.empty(0)
         self.sample_rate = sample_rate
+        self.n_mel_channels = n_mel_channels
         self.filter_length = filter_length
         self.hop_length = hop_length
+        self.win_length = win_length
         self.mel_fmin = mel_fmin
         self.mel_fmax = mel_fmax
         self.include_f0 = include_f0
@@ -94,10 +168,124 @@ class TextMelDataset(Dataset):
         self.f0_max = f0_max
         self.harmonic_threshold = harmonic_thresh
         # speaker id lookup table
-        speaker_ids = [i[2] for i in self.audiopaths_and_text]
+        speaker_ids = self.audiopaths_and_text.column(2)
         self._speaker_id_map = _orig_to_dense_speaker_id(speaker_ids)
+        self.token_cache = None
+        if token_cache is not None:
+            self.token_cache = _open_token_cache(
+                token_cache,
+                self.audiopaths_and_text.column(1),
+                text_cleaners,
+                include_arpabet=p_arpabet > 0,
+            )
         self.debug = debug
         self.debug_dataset_size = debug_dataset_size
+        self._lengths = None
+        self.manifest_path = manifest
+        self.feature_store = None
+        if feature_store is not None:
+            if FeatureStore.exists(feature_store, self.feature_store_config):
+                self.feature_store = FeatureStore(
+                    feature_store, self.feature_store_config
+                )
+            else:
+                print(
+                    f"No feature store matching this config in {feature_store}, computing features on the fly."
+                )
+
+    @property
+    def lengths(self):
+        """Approximate mel lengths in frames, for length-aware batching."""
+        if self._lengths is None:
+            paths = self.audiopaths_and_text.column(0)
+            if self.manifest_path is not None:
+                manifest = WavManifest(self.manifest_path)
+                # Only read clips missing from the manifest, so that startup
+                # doesn't stat every clip; exec.build_manifest refreshes clips
+                # that changed.
+                manifest.update(paths, check_mtime=False)
+                lengths = manifest.lengths(paths, self.hop_length, self.sample_rate)
+            else:
+                # 16-bit mono wavs: 2 bytes per sample.
+                lengths = np.array(
+                    [os.path.getsize(path) for path in paths], dtype=np.int64
+                ) // (2 * self.hop_length)
+            lengths += 1
+            if self.feature_store is not None:
+                for i, path in enumerate(paths):
+                    if path in self.feature_store:
+                        lengths[i] = self.feature_store.n_frames(path)
+            self._lengths = lengths
+        return self._lengths
+
+    @property
+    def _store_text(self):
+        # Text sequences are only deterministic if arpabet is never or always used.
+        return self.p_arpabet in (0.0, 1.0)
+
+    @property
+    def feature_store_config(self):
+        """Everything the stored features depend on. Changing any of these invalidates the store."""
+        config = dict(
+            filter_length=self.filter_length,
+            hop_length=self.hop_length,
+            win_length=self.win_length,
+            n_mel_channels=self.n_mel_channels,
+            sample_rate=self.sample_rate,
+            mel_fmin=self.mel_fmin,
+            mel_fmax=self.mel_fmax,
+            max_wav_value=self.max_wav_value,
+            include_f0=self.include_f0,
+        )
+        if self.include_f0:
+            config.update(
+                f0_min=self.f0_min,
+                f0_max=self.f0_max,
+                harmonic_threshold=self.harmonic_threshold,
+            )
+        if self._store_text:
+            config.update(text_cleaners=self.text_cleaners, p_arpabet=self.p_arpabet)
+        return config
+
+    def build_feature_store(self, root, shard_size=DEFAULT_SHARD_SIZE):
+        """Compute features for every clip once and write them to a feature store under root."""
+        writer = FeatureStoreWriter(
+            root,
+            self.feature_store_config,
+            self.n_mel_channels,
+            include_f0=self.include_f0,
+            include_text=self._store_text,
+            shard_size=shard_size,
+        )
+        seen = set()
+        for path, transcription, _ in self.audiopaths_and_text:
+            if path in seen:
+                continue
+            seen.add(path)
+            melspec, f0 = self._compute_features(path)
+            text_sequence = self._get_text(transcription) if self._store_text else None
+            writer.add(path, melspec, f0=f0, text=text_sequence)
+        store_path = writer.close()
+        self.feature_store = FeatureStore(root, self.feature_store_config)
+        return store_path
+
+    def pack_shards(self, root, max_shard_size=DEFAULT_SHARD_SIZE):
+        """Pack every clip, with its features, into tar shards under root."""
+        writer = ShardWriter(
+            root,
+            max_shard_size=max_shard_size,
+            features_key=feature_store_key(self.feature_store_config),
+        )
+        for path, transcription, speaker_id in self.audiopaths_and_text:
+            melspec, f0 = self._compute_features(path)
+            writer.add(
+                path,
+                transcription,
+                speaker_id,
+                mel=melspec.numpy(),
+                f0=None if f0 is None else f0.numpy(),
+            )
+        return writer.close()
 
     def _get_f0(self, audio):
         f0, harmonic_rates, argmins, times = compute_yin(
@@ -114,28 +302,66 @@ class TextMelDataset(Dataset):
         f0 = np.array(f0, dtype=np.float32)
         return f0
 
-    def _get_data(self, audiopath_and_text):
-        path, transcription, speaker_id = audiopath_and_text
-        speaker_id = self._speaker_id_map[speaker_id]
-        sample_rate, wav_data = read(path)
-        text_sequence = torch.LongTensor(
+    def _get_text(self, transcription):
+        if self.token_cache is not None and transcription in self.token_cache:
+            return torch.LongTensor(
+                self.token_cache.get(transcription, p_arpabet=self.p_arpabet)
+            )
+        return torch.LongTensor(
             text_to_sequence(
                 transcription, self.text_cleaners, p_arpabet=self.p_arpabet
             )
         )
-        audio = torch.FloatTensor(wav_data)
-        audio_norm = audio / self.max_wav_value
-        audio_norm = audio_norm.unsqueeze(0)
-        melspec = self.stft.mel_spectrogram(audio_norm)
+
+    def _compute_features(self, path):
+        # NOTE: only the features leave this method, so every item can
+        # decode into the same buffer.
+        audio_norm, _ = load_wav_to_torch(
+            path, self.max_wav_value, out=self._wav_buffer
+        )
+        melspec = self.stft.mel_spectrogram(audio_norm.unsqueeze(0))
         melspec = torch.squeeze(melspec, 0)
+        if not self.include_f0:
+            return melspec, None
+        f0 = self._get_f0(audio_norm.numpy() * self.max_wav_value)
+        return melspec, torch.from_numpy(f0)
+
+    def _get_data(self, audiopath_and_text):
+        path, transcription, speaker_id = audiopath_and_text
+        speaker_id = self._speaker_id_map[speaker_id]
+        text_sequence = None
+        if self.feature_store is not None and path in self.feature_store:
+            melspec, f0, text_sequence = self.feature_store.get(path)
+        else:
+            melspec, f0 = self._compute_features(path)
+        if text_sequence is None:
+            text_sequence = self._get_text(transcription)
+        return self._item(text_sequence, melspec, speaker_id, f0)
+
+    def _item(self, text_sequence, melspec, speaker_id, f0):
         if not self.include_f0:
             return (text_sequence, melspec, speaker_id)
-        f0 = self._get_f0(audio.data.cpu().numpy())
-        f0 = torch.from_numpy(f0)[None]
+        f0 = f0[None]
         f0 = f0[:, : melspec.size(1)]
 
         return (text_sequence, melspec, speaker_id, f0)
 
+    def decode_sample(self, sample):
+        """Turn a sample streamed by ShardedDataset into a dataset item.
+
+        Packed features are used if they were computed with this dataset's
+        feature config, and recomputed from the packed audio otherwise.
+        """
+        speaker_id = self._speaker_id_map[sample["sid"]]
+        if "mel" in sample and sample["features_key"] == feature_store_key(
+            self.feature_store_config
+        ):
+            melspec = torch.from_numpy(sample["mel"])
+            f0 = torch.from_numpy(sample["f0"]) if "f0" in sample else None
+        else:
+            melspec, f0 = self._compute_features(io.BytesIO(sample["audio"]))
+        return self._item(self._get_text(sample["text"]), melspec, speaker_id, f0)
+
     def __getitem__(self, idx):
         """Return data for a single audio file + transcription."""
         try:
@@ -154,9 +380,35 @@ class TextMelDataset(Dataset):
 
 
 class TextMelCollate:
-    def __init__(self, n_frames_per_step: int = 1, include_f0: bool = False):
+    """Zero-pads text, mels, gates and f0s into batch tensors.
+
+    Rows are copied into the batch with numpy slice copies, and only the
+    padding past each row is zeroed. With num_buffers > 0, padded tensors are
+    views into a ring of num_buffers buffers that are reused from batch to
+    batch and grown to the largest batch seen. This skips allocating (and page
+    faulting) tens of MB per batch, but a batch is only valid until
+    num_buffers more batches have been collated, so only use it when batches
+    are consumed as they are produced. With pin_memory, the padded tensors are
+    in pinned memory.
+
+    In a DataLoader worker (num_workers > 0), each worker would get its own
+    copy of the ring, and its batches are copied to shared memory on their
+    way to the main process anyway, so the ring and pin_memory are ignored
+    there; use the DataLoader's pin_memory instead.
+    """
+
+    def __init__(
+        self,
+        n_frames_per_step: int = 1,
+        include_f0: bool = False,
+        pin_memory: bool = False,
+        num_buffers: int = 0,
+    ):
         self.n_frames_per_step = n_frames_per_step
         self.include_f0 = include_f0
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._buffers = [{} for _ in range(num_buffers)]
+        self._buffer_idx = 0
 
     def set_frames_per_step(self, n_frames_per_step):
         """Set n_frames_step.
@@ -169,53 +421,85 @@ class TextMelCollate:
         """
         self.n_frames_per_step = n_frames_per_step
 
+    def _empty(self, buffers, name, shape, dtype, pin_memory):
+        """An uninitialized tensor of shape, from buffers if given."""
+        numel = int(np.prod(shape))
+        if buffers is None:
+            return torch.empty(shape, dtype=dtype, pin_memory=pin_memory)
+        buffer = buffers.get(name)
+        if buffer is None or buffer.numel() < numel:
+            buffer = torch.empty(numel, dtype=dtype, pin_memory=pin_memory)
+            buffers[name] = buffer
+        return buffer[:numel].view(shape)
+
     def __call__(self, batch):
         """Collate's training batch from normalized text and mel-spectrogram
         PARAMS
         ------
         batch: [text_normalized, mel_normalized, speaker_id]
         """
-        # Right zero-pad all one-hot text sequences to max input length
         input_lengths, ids_sorted_decreasing = torch.sort(
             torch.LongTensor([len(x[0]) for x in batch]), dim=0, descending=True
         )
-        max_input_len = input_lengths[0]
+        batch = [batch[i] for i in ids_sorted_decreasing.tolist()]
+        batch_size = len(batch)
+        max_input_len = int(input_lengths[0])
+        output_lengths = torch.LongTensor([x[1].size(1) for x in batch])
+        speaker_ids = torch.LongTensor([int(x[2]) for x in batch])
 
-        text_padded = torch.LongTensor(len(batch), max_input_len)
-        text_padded.zero_()
-        for i in range(len(ids_sorted_decreasing)):
-            text = batch[ids_sorted_decreasing[i]][0]
-            text_padded[i, : text.size(0)] = text
-
-        # Right zero-pad mel-spec
         num_mels = batch[0][1].size(0)
-        max_target_len = max([x[1].size(1) for x in batch])
-        if max_target_len % self.n_frames_per_step != 0:
-            max_target_len += (
-                self.n_frames_per_step - max_target_len % self.n_frames_per_step
+        max_target_len = int(output_lengths.max())
+        # Round up to a multiple of n_frames_per_step.
+        max_target_len = -(-max_target_len // self.n_frames_per_step) * (
+            self.n_frames_per_step
+        )
+
+        buffers = None
+        pin_memory = self.pin_memory
+        if get_worker_info() is not None:
+            pin_memory = False
+        elif self._buffers:
+            buffers = self._buffers[self._buffer_idx]
+            self._buffer_idx = (self._buffer_idx + 1) % len(self._buffers)
+        text_padded = self._empty(
+            buffers, "text", (batch_size, max_input_len), torch.long, pin_memory
+        )
+        mel_padded = self._empty(
+            buffers,
+            "mel",
+            (batch_size, num_mels, max_target_len),
+            torch.float,
+            pin_memory,
+        )
+        gate_padded = self._empty(
+            buffers, "gate", (batch_size, max_target_len), torch.float, pin_memory
+        )
+        # The gate is 1 from the last frame of each mel onwards.
+        gate_padded.copy_(
+            torch.arange(max_target_len)[None, :] >= (output_lengths - 1)[:, None]
+        )
+        if self.include_f0:
+            f0_padded = self._empty(
+                buffers, "f0", (batch_size, 1, max_target_len), torch.float, pin_memory
             )
-            assert max_target_len % self.n_frames_per_step == 0
-
-        # include mel padded, gate padded and speaker ids
-        mel_padded = torch.FloatTensor(len(batch), num_mels, max_target_len)
-        mel_padded.zero_()
-        gate_padded = torch.FloatTensor(len(batch), max_target_len)
-        gate_padded.zero_()
-        output_lengths = torch.LongTensor(len(batch))
-        speaker_ids = torch.LongTensor(len(batch))
+
+        # NOTE: numpy slice copies benchmarked about twice as fast as torch
+        # slice assignment for these row copies.
+        text_np = text_padded.numpy()
+        mel_np = mel_padded.numpy()
         if self.include_f0:
-            f0_padded = torch.FloatTensor(len(batch), 1, max_target_len)
-            f0_padded.zero_()
-
-        for i in range(len(ids_sorted_decreasing)):
-            mel = batch[ids_sorted_decreasing[i]][1]
-            mel_padded[i, :, : mel.size(1)] = mel
-            gate_padded[i, mel.size(1) - 1 :] = 1
-            output_lengths[i] = mel.size(1)
-            speaker_ids[i] = batch[ids_sorted_decreasing[i]][2]
+            f0_np = f0_padded.numpy()
+        for i, row in enumerate(batch):
+            n = row[0].size(0)
+            text_np[i, :n] = row[0].numpy()
+            text_np[i, n:] = 0
+            n = row[1].size(1)
+            mel_np[i, :, :n] = row[1].numpy()
+            mel_np[i, :, n:] = 0
             if self.include_f0:
-                f0 = batch[ids_sorted_decreasing[i]][3]
-                f0_padded[i, :, : f0.size(1)] = f0
+                n = row[3].size(1)
+                f0_np[i, :, :n] = row[3].numpy()
+                f0_np[i, :, n:] = 0
 
         # NOTE(zach): would model_inputs be better as a namedtuple or dataclass?
         if self.include_f0:
@@ -243,20 +527,122 @@ class TextMelCollate:
 # Cell
 
 
+class FrameBudgetBatchSampler(Sampler):
+    """Batch sampler that packs batches up to a budget of padded mel frames.
+
+    Batch size varies with clip length: short clips make large batches and long
+    clips make small ones, so every batch is roughly max_frames frames after
+    padding (rounded up to n_frames_per_step, like TextMelCollate does).
+
+    Each epoch, indices are shuffled and split into pools of pool_size, each
+    pool is sorted by length and packed greedily, and the batches are shuffled.
+    Every rank builds the same batches from seed + epoch and takes every
+    num_replicas-th one.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        max_frames: int,
+        n_frames_per_step: int = 1,
+        num_replicas=None,
+        rank=None,
+        shuffle=True,
+        seed=0,
+        pool_size=10000,
+        max_batch_size=None,
+    ):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_initialized() else 0
+        self.lengths = np.asarray(dataset.lengths[: len(dataset)], dtype=np.int64)
+        self.weights = getattr(dataset, "sample_weights", None)
+        if self.weights is not None:
+            self.weights = self.weights[: len(dataset)]
+        self.max_frames = max_frames
+        self.n_frames_per_step = n_frames_per_step
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.pool_size = pool_size
+        self.max_batch_size = max_batch_size
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = None
+
+    def _pack(self, indices):
+        """Greedily pack indices, sorted by ascending length, into batches."""
+        k = self.n_frames_per_step
+        padded = -(-self.lengths[indices] // k) * k
+        batches = []
+        start = 0
+        while start < len(indices):
+            max_size = max(1, self.max_frames // padded[start])
+            if self.max_batch_size:
+                max_size = min(max_size, self.max_batch_size)
+            end = min(start + max_size, len(indices))
+            # Lengths are ascending, so the last clip sets the padded length.
+            sizes = np.arange(1, end - start + 1)
+            fits = sizes * padded[start:end] <= self.max_frames
+            end = start + max(1, int(fits.sum()))
+            batches.append(indices[start:end])
+            start = end
+        return batches
+
+    @property
+    def batches(self):
+        if self._batches is None:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            indices = _expand_by_weight(np.arange(len(self.lengths)), self.weights)
+            if self.shuffle:
+                indices = rng.permutation(indices)
+            batches = []
+            for pool_start in range(0, len(indices), self.pool_size):
+                pool = indices[pool_start : pool_start + self.pool_size]
+                pool = pool[np.argsort(self.lengths[pool], kind="stable")]
+                batches.extend(self._pack(pool))
+            if self.shuffle:
+                batches = [batches[i] for i in rng.permutation(len(batches))]
+            # Every rank needs the same number of batches.
+            num_batches = len(batches) // self.num_replicas * self.num_replicas
+            self._batches = [
+                b.tolist() for b in batches[self.rank : num_batches : self.num_replicas]
+            ]
+        return self._batches
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+# Cell
+
+
 class TextAudioSpeakerLoader(Dataset):
     """
     1) loads audio, speaker_id, text pairs
     2) normalizes text and converts them to sequences of integers
     3) computes spectrograms from audio files.
+
+    With audiopaths_sid_text=None, there is no filelist: the loader only turns
+    samples streamed from hparams.sharded_dataset_path into items with
+    decode_sample, without touching the per-clip wavs.
     """
 
     def __init__(
         self, audiopaths_sid_text, hparams, debug=False, debug_dataset_size=None
     ):
-        oversample_weights = hparams.oversample_weights or {}
-        self.audiopaths_sid_text = oversample(
-            load_filepaths_and_text(audiopaths_sid_text), oversample_weights
-        )
+        self.oversample_weights = hparams.oversample_weights or {}
+        if audiopaths_sid_text is None:
+            data_dir = hparams.sharded_dataset_path
+        else:
+            data_dir = os.path.dirname(audiopaths_sid_text)
         self.text_cleaners = hparams.text_cleaners
         self.max_wav_value = hparams.max_wav_value
         self.sampling_rate = hparams.sampling_rate
@@ -268,7 +654,7 @@ class TextAudioSpeakerLoader(Dataset):
         self.debug = debug
         self.debug_dataset_size = debug_dataset_size
 
-        self.stft = MelSTFT(
+        self.stft = get_mel_stft(
             filter_length=self.filter_length,
             hop_length=self.hop_length,
             win_length=self.win_length,
@@ -277,6 +663,24 @@ class TextAudioSpeakerLoader(Dataset):
             mel_fmin=hparams.mel_fmin,
             mel_fmax=hparams.mel_fmax,
             padding=(self.filter_length - self.hop_length) // 2,
+            stft_backend=getattr(hparams, "stft_backend", "conv"),
+        )
+        self.manifest_path = getattr(hparams, "manifest_path", None)
+        if self.manifest_path is None:
+            self.manifest_path = os.path.join(data_dir, "wav_manifest.npz")
+        spec_cache_path = getattr(hparams, "spec_cache_path", None)
+        if spec_cache_path is None:
+            spec_cache_path = os.path.join(data_dir, "spec_cache")
+        self.spec_cache = SpectrogramCache(
+            spec_cache_path,
+            dict(
+                filter_length=self.filter_length,
+                hop_length=self.hop_length,
+                win_length=self.win_length,
+                sampling_rate=self.sampling_rate,
+                max_wav_value=self.max_wav_value,
+            ),
+            n_channels=self.filter_length // 2 + 1,
         )
 
         self.cleaned_text = getattr(hparams, "cleaned_text", False)
@@ -287,26 +691,45 @@ class TextAudioSpeakerLoader(Dataset):
         self.min_text_len = getattr(hparams, "min_text_len", 1)
         self.max_text_len = getattr(hparams, "max_text_len", 190)
 
+        self.token_cache = None
+        if audiopaths_sid_text is None:
+            self.audiopaths_sid_text = None
+            return
+        self.audiopaths_sid_text = load_filepaths_and_text(
+            audiopaths_sid_text, columnar=True
+        )
+        token_cache_path = getattr(hparams, "token_cache_path", None)
+        if token_cache_path is not None and not self.cleaned_text:
+            self.token_cache = _open_token_cache(
+                token_cache_path,
+                self.audiopaths_sid_text.column(1),
+                self.text_cleaners,
+            )
+
         random.seed(1234)
-        random.shuffle(self.audiopaths_sid_text)
+        order = list(range(len(self.audiopaths_sid_text)))
+        random.shuffle(order)
+        self.audiopaths_sid_text = self.audiopaths_sid_text.take(order)
         self._filter()
 
     def _filter(self):
         """
         Filter text & store spec lengths
         """
-        # Store spectrogram lengths for Bucketing
-        # wav_length ~= file_size / (wav_channels * Bytes per dim) = file_size / (1 * 2)
-        # spec_length = wav_length // hop_length
-
-        audiopaths_sid_text_new = []
-        lengths = []
-        for audiopath, sid, text in self.audiopaths_sid_text:
-            if self.min_text_len <= len(text) and len(text) <= self.max_text_len:
-                audiopaths_sid_text_new.append([audiopath, sid, text])
-                lengths.append(os.path.getsize(audiopath) // (2 * self.hop_length))
-        self.audiopaths_sid_text = audiopaths_sid_text_new
-        self.lengths = lengths
+        # Store spectrogram lengths for Bucketing, from the wav headers.
+        # spec_length ~= wav_length // hop_length
+        text_lengths = self.audiopaths_sid_text.char_lengths(1)
+        keep = np.flatnonzero(
+            (self.min_text_len <= text_lengths) & (text_lengths <= self.max_text_len)
+        )
+        self.audiopaths_sid_text = self.audiopaths_sid_text.take(keep)
+        paths = self.audiopaths_sid_text.column(0)
+        manifest = WavManifest(self.manifest_path)
+        manifest.update(paths, check_mtime=False)
+        self.lengths = manifest.lengths(paths, self.hop_length, self.sampling_rate)
+        self.sample_weights = sample_weights(
+            self.audiopaths_sid_text, self.oversample_weights
+        )
 
     def get_audio_text_speaker_pair(self, audiopath_sid_text):
         # separate filename, speaker_id and text
@@ -320,8 +743,11 @@ class TextAudioSpeakerLoader(Dataset):
         sid = self.get_sid(sid)
         return (text, spec, wav, sid)
 
-    def get_audio(self, filename):
-        audio, sampling_rate = load_wav_to_torch(filename)
+    def get_audio(self, filename, audio_file=None):
+        """Load a clip and its spectrogram. audio_file, if given, holds the wav bytes."""
+        audio_norm, sampling_rate = load_wav_to_torch(
+            filename if audio_file is None else audio_file, self.max_wav_value
+        )
         if sampling_rate != self.sampling_rate:
             raise ValueError(
                 "{} {} SR doesn't match target {} SR".format(
@@ -329,20 +755,19 @@ class TextAudioSpeakerLoader(Dataset):
                 )
             )
 
-        audio_norm = audio / self.max_wav_value
         audio_norm = audio_norm.unsqueeze(0)
-        spec_filename = filename.replace(".wav", ".uberduck.spec.pt")
-        if os.path.exists(spec_filename):
-            spec = torch.load(spec_filename)
-        else:
+        spec = self.spec_cache.get(filename)
+        if spec is None:
             spec = self.stft.spectrogram(audio_norm)
             spec = torch.squeeze(spec, 0)
-            torch.save(spec, spec_filename)
+            self.spec_cache.put(filename, spec)
         return spec, audio_norm
 
     def get_text(self, text):
         if self.cleaned_text:
             text_norm = cleaned_text_to_sequence(text, symbol_set=self.symbol_set)
+        elif self.token_cache is not None and text in self.token_cache:
+            text_norm = self.token_cache.get(text)
         else:
             text_norm = text_to_sequence(
                 text, self.text_cleaners, symbol_set=self.symbol_set
@@ -356,6 +781,19 @@ class TextAudioSpeakerLoader(Dataset):
         sid = torch.LongTensor([int(sid)])
         return sid
 
+    def decode_sample(self, sample):
+        """Turn a sample streamed by ShardedDataset into a dataset item.
+
+        Returns None for transcripts outside the text length bounds, which
+        ShardedDataset skips, as _filter does for the filelist.
+        """
+        if not self.min_text_len <= len(sample["text"]) <= self.max_text_len:
+            return None
+        text = self.get_text(sample["text"])
+        spec, wav = self.get_audio(sample["path"], io.BytesIO(sample["audio"]))
+        sid = self.get_sid(sample["sid"])
+        return (text, spec, wav, sid)
+
     def __getitem__(self, index):
         return self.get_audio_text_speaker_pair(self.audiopaths_sid_text[index])
 
@@ -369,10 +807,22 @@ class TextAudioSpeakerLoader(Dataset):
 
 
 class TextAudioSpeakerCollate:
-    """Zero-pads model inputs and targets"""
+    """Zero-pads model inputs and targets
+
+    With ragged_wav, waveforms are not padded to the longest clip. They are
+    concatenated into a single 1-d tensor in batch order instead, and can be
+    sliced with slice_ragged_segments using the returned wav lengths. This
+    keeps mostly-padding audio out of the batch, since training only uses a
+    segment_size slice of each clip.
+    """
 
-    def __init__(self, return_ids=False):
+    def __init__(self, return_ids=False, ragged_wav=False):
         self.return_ids = return_ids
+        self.ragged_wav = ragged_wav
+
+    @staticmethod
+    def _length_mask(lengths):
+        return torch.arange(int(lengths.max())) < lengths[:, None]
 
     def __call__(self, batch):
         """Collate's training batch from normalized text, audio and speaker identities
@@ -381,41 +831,30 @@ class TextAudioSpeakerCollate:
         batch: [text_normalized, spec_normalized, wav_normalized, sid]
         """
         # Right zero-pad all one-hot text sequences to max input length
-        _, ids_sorted_decreasing = torch.sort(
+        spec_lengths, ids_sorted_decreasing = torch.sort(
             torch.LongTensor([x[1].size(1) for x in batch]), dim=0, descending=True
         )
-
-        max_text_len = max([len(x[0]) for x in batch])
-        max_spec_len = max([x[1].size(1) for x in batch])
-        max_wav_len = max([x[2].size(1) for x in batch])
-
-        text_lengths = torch.LongTensor(len(batch))
-        spec_lengths = torch.LongTensor(len(batch))
-        wav_lengths = torch.LongTensor(len(batch))
-        sid = torch.LongTensor(len(batch))
-
-        text_padded = torch.LongTensor(len(batch), max_text_len)
-        spec_padded = torch.FloatTensor(len(batch), batch[0][1].size(0), max_spec_len)
-        wav_padded = torch.FloatTensor(len(batch), 1, max_wav_len)
-        text_padded.zero_()
-        spec_padded.zero_()
-        wav_padded.zero_()
-        for i in range(len(ids_sorted_decreasing)):
-            row = batch[ids_sorted_decreasing[i]]
-
-            text = row[0]
-            text_padded[i, : text.size(0)] = text
-            text_lengths[i] = text.size(0)
-
-            spec = row[1]
-            spec_padded[i, :, : spec.size(1)] = spec
-            spec_lengths[i] = spec.size(1)
-
-            wav = row[2]
-            wav_padded[i, :, : wav.size(1)] = wav
-            wav_lengths[i] = wav.size(1)
-
-            sid[i] = row[3]
+        batch = [batch[i] for i in ids_sorted_decreasing.tolist()]
+        text_lengths = torch.LongTensor([len(x[0]) for x in batch])
+        wav_lengths = torch.LongTensor([x[2].size(1) for x in batch])
+        sid = torch.LongTensor([int(x[3]) for x in batch])
+
+        # Each padded tensor is filled in one masked assignment: the mask is
+        # True at the valid positions of each row, in row-major order, which
+        # is the order of the concatenated rows.
+        text_padded = torch.zeros(len(batch), int(text_lengths.max()), dtype=torch.long)
+        text_padded[self._length_mask(text_lengths)] = torch.cat([x[0] for x in batch])
+        spec_padded = torch.zeros(len(batch), batch[0][1].size(0), int(spec_lengths[0]))
+        spec_padded.transpose(1, 2)[self._length_mask(spec_lengths)] = torch.cat(
+            [x[1].t() for x in batch]
+        )
+        if self.ragged_wav:
+            wav_padded = torch.cat([x[2][0] for x in batch])
+        else:
+            wav_padded = torch.zeros(len(batch), 1, int(wav_lengths.max()))
+            wav_padded[:, 0][self._length_mask(wav_lengths)] = torch.cat(
+                [x[2][0] for x in batch]
+            )
 
         if self.return_ids:
             return (
@@ -441,6 +880,44 @@ class TextAudioSpeakerCollate:
 # Cell
 
 
+def bucket_boundaries(lengths, batch_size, num_buckets=10, num_candidates=256):
+    """Choose bucket boundaries that minimize padding for the given lengths.
+
+    Every item in a bucket (lo, hi] is assumed to be padded to hi, so a bucket
+    costs count * hi - sum(lengths) padded frames. The best cuts among
+    num_candidates length quantiles are found with dynamic programming, and
+    every bucket gets at least batch_size items.
+    """
+    lengths = np.sort(np.asarray(lengths, dtype=np.int64))
+    idx = np.linspace(0, len(lengths) - 1, num_candidates).astype(np.int64)
+    cuts = np.unique(lengths[idx])
+    counts = np.concatenate([[0], np.searchsorted(lengths, cuts, side="right")])
+    n = len(cuts)
+    # cost[k, j]: fewest padded frames for the items <= cuts[j - 1] in k buckets.
+    cost = np.full((num_buckets + 1, n + 1), np.inf)
+    prev = np.zeros((num_buckets + 1, n + 1), dtype=np.int64)
+    cost[0, 0] = 0
+    for k in range(1, num_buckets + 1):
+        for j in range(1, n + 1):
+            size = counts[j] - counts[:j]
+            total = cost[k - 1, :j] + size * cuts[j - 1]
+            total[size < batch_size] = np.inf
+            prev[k, j] = np.argmin(total)
+            cost[k, j] = total[prev[k, j]]
+    k = int(np.argmin(cost[:, n]))
+    if not np.isfinite(cost[k, n]):
+        # Fewer than batch_size items: use a single bucket.
+        return [int(lengths[0]) - 1, int(lengths[-1])]
+    boundaries = []
+    j = n
+    while k > 0:
+        boundaries.append(int(cuts[j - 1]))
+        j = prev[k, j]
+        k -= 1
+    boundaries.append(int(lengths[0]) - 1)
+    return boundaries[::-1]
+
+
 class DistributedBucketSampler(DistributedSampler):
     """
     Maintain similar input lengths in a batch.
@@ -449,112 +926,132 @@ class DistributedBucketSampler(DistributedSampler):
 
     It removes samples which are not included in the boundaries.
     Ex) boundaries = [b1, b2, b3] -> any x s.t. length(x) <= b1 or length(x) > b3 are discarded.
+
+    If boundaries is None, they are chosen with bucket_boundaries to minimize
+    padding. The fraction of padded frames in each epoch's batches is stored in
+    padding_ratio.
     """
 
     def __init__(
         self,
         dataset,
         batch_size,
-        boundaries,
+        boundaries=None,
         num_replicas=None,
         rank=None,
         shuffle=True,
+        num_buckets=10,
     ):
         super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle)
-        self.lengths = dataset.lengths
+        self.lengths = np.asarray(dataset.lengths, dtype=np.int64)
+        self.weights = getattr(dataset, "sample_weights", None)
         self.batch_size = batch_size
-        self.boundaries = boundaries
+        if boundaries is None:
+            boundaries = bucket_boundaries(
+                self.lengths, batch_size * self.num_replicas, num_buckets
+            )
+        self.boundaries = list(boundaries)
+        self.padding_ratio = None
 
         self.buckets, self.num_samples_per_bucket = self._create_buckets()
         self.total_size = sum(self.num_samples_per_bucket)
         self.num_samples = self.total_size // self.num_replicas
 
     def _create_buckets(self):
-        buckets = [[] for _ in range(len(self.boundaries) - 1)]
-        for i in range(len(self.lengths)):
-            length = self.lengths[i]
-            idx_bucket = self._bisect(length)
-            if idx_bucket != -1:
-                buckets[idx_bucket].append(i)
+        # length in (boundaries[i], boundaries[i + 1]] -> bucket i
+        idx_buckets = (
+            np.searchsorted(np.asarray(self.boundaries), self.lengths, side="left") - 1
+        )
+        order = np.argsort(idx_buckets, kind="stable")
+        bucket_sizes = np.bincount(
+            idx_buckets[(idx_buckets >= 0) & (idx_buckets < len(self.boundaries) - 1)],
+            minlength=len(self.boundaries) - 1,
+        )
+        start = np.searchsorted(idx_buckets[order], 0)
+        buckets = np.split(order[start:], np.cumsum(bucket_sizes))[:-1]
+        buckets = [_expand_by_weight(bucket, self.weights) for bucket in buckets]
 
         for i in range(len(buckets) - 1, 0, -1):
             if len(buckets[i]) == 0:
                 buckets.pop(i)
                 self.boundaries.pop(i + 1)
 
-        num_samples_per_bucket = []
-        for i in range(len(buckets)):
-            len_bucket = len(buckets[i])
-            total_batch_size = self.num_replicas * self.batch_size
-            rem = (
-                total_batch_size - (len_bucket % total_batch_size)
-            ) % total_batch_size
-            num_samples_per_bucket.append(len_bucket + rem)
+        total_batch_size = self.num_replicas * self.batch_size
+        num_samples_per_bucket = [
+            -(-len(bucket) // total_batch_size) * total_batch_size for bucket in buckets
+        ]
         return buckets, num_samples_per_bucket
 
     def __iter__(self):
         # deterministically shuffle based on epoch
-        g = torch.Generator()
-        g.manual_seed(self.epoch)
-
-        indices = []
-        if self.shuffle:
-            for bucket in self.buckets:
-                indices.append(torch.randperm(len(bucket), generator=g).tolist())
-        else:
-            for bucket in self.buckets:
-                indices.append(list(range(len(bucket))))
+        rng = np.random.default_rng(self.seed + self.epoch)
 
         batches = []
-        for i in range(len(self.buckets)):
-            bucket = self.buckets[i]
-            len_bucket = len(bucket)
-            ids_bucket = indices[i]
-            num_samples_bucket = self.num_samples_per_bucket[i]
-
+        for bucket, num_samples_bucket in zip(
+            self.buckets, self.num_samples_per_bucket
+        ):
+            if self.shuffle:
+                ids_bucket = rng.permutation(len(bucket))
+            else:
+                ids_bucket = np.arange(len(bucket))
             # add extra samples to make it evenly divisible
-            rem = num_samples_bucket - len_bucket
-            ids_bucket = (
-                ids_bucket
-                + ids_bucket * (rem // len_bucket)
-                + ids_bucket[: (rem % len_bucket)]
-            )
-
+            ids_bucket = np.resize(ids_bucket, num_samples_bucket)
             # subsample
             ids_bucket = ids_bucket[self.rank :: self.num_replicas]
-
-            # batching
-            for j in range(len(ids_bucket) // self.batch_size):
-                batch = [
-                    bucket[idx]
-                    for idx in ids_bucket[
-                        j * self.batch_size : (j + 1) * self.batch_size
-                    ]
-                ]
-                batches.append(batch)
+            batches.append(bucket[ids_bucket].reshape(-1, self.batch_size))
+        batches = np.concatenate(batches)
 
         if self.shuffle:
-            batch_ids = torch.randperm(len(batches), generator=g).tolist()
-            batches = [batches[i] for i in batch_ids]
-        self.batches = batches
+            batches = batches[rng.permutation(len(batches))]
+
+        batch_lengths = self.lengths[batches]
+        self.padding_ratio = 1 - batch_lengths.sum() / (
+            batch_lengths.max(axis=1).sum() * self.batch_size
+        )
+        self.batches = batches.tolist()
 
         assert len(self.batches) * self.batch_size == self.num_samples
         return iter(self.batches)
 
-    def _bisect(self, x, lo=0, hi=None):
-        if hi is None:
-            hi = len(self.boundaries) - 1
+    def __len__(self):
+        return self.num_samples // self.batch_size
 
-        if hi > lo:
-            mid = (hi + lo) // 2
-            if self.boundaries[mid] < x and x <= self.boundaries[mid + 1]:
-                return mid
-            elif x <= self.boundaries[mid]:
-                return self._bisect(x, lo, mid)
-            else:
-                return self._bisect(x, mid + 1, hi)
+
+class WeightedDistributedSampler(DistributedSampler):
+    """DistributedSampler that draws indices in proportion to dataset.sample_weights.
+
+    If num_samples is None, each epoch is a permutation of every index repeated
+    by its rounded weight, the same as training on an oversampled filelist.
+    Otherwise num_samples indices per epoch are drawn with replacement.
+    """
+
+    def __init__(self, dataset, num_samples=None, num_replicas=None, rank=None, seed=0):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, seed=seed)
+        weights = getattr(dataset, "sample_weights", None)
+        if weights is None:
+            weights = np.ones(len(dataset))
+        self.weights = np.asarray(weights[: len(dataset)], dtype=np.float64)
+        self.replacement = num_samples is not None
+        if num_samples is None:
+            num_samples = int(np.rint(self.weights).sum())
+        self.num_samples = num_samples // self.num_replicas
+        self.total_size = self.num_samples * self.num_replicas
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        if self.replacement:
+            indices = rng.choice(
+                len(self.weights),
+                self.total_size,
+                replace=True,
+                p=self.weights / self.weights.sum(),
+            )
         else:
-            return -1
+            indices = rng.permutation(
+                _expand_by_weight(np.arange(len(self.weights)), self.weights)
+            )
+        indices = indices[self.rank : self.total_size : self.num_replicas]
+        return iter(indices.tolist())
 
     def __len__(self):
-        return self.num_samples // self.batch_size
\ No newline at end of file
+        return self.num_samples
\ No newline at end of file
@@ -0,0 +1,68 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/exec.build_feature_store.ipynb (unless otherwise specified).
+
+__all__ = ['parse_args', 'build_feature_store']
+
+# Cell
+import argparse
+import json
+import librosa  # NOTE(zach): importing torch before librosa causes LLVM issues for some unknown reason.
+import sys
+
+from ..data_loader import TextMelDataset
+from ..vendor.tfcompat.hparam import HParams
+from ..models.mellotron import DEFAULTS as MELLOTRON_DEFAULTS
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="Path to JSON config")
+    parser.add_argument(
+        "--out",
+        help="Feature store directory. Defaults to feature_store_path from the config.",
+    )
+    args = parser.parse_args(args)
+    return args
+
+
+def build_feature_store(hparams, out):
+    dataset_args = [
+        hparams.text_cleaners,
+        hparams.p_arpabet,
+        # audio params
+        hparams.n_mel_channels,
+        hparams.sampling_rate,
+        hparams.mel_fmin,
+        hparams.mel_fmax,
+        hparams.filter_length,
+        hparams.hop_length,
+        hparams.win_length,
+        hparams.max_wav_value,
+        hparams.include_f0,
+        hparams.pos_weight,
+    ]
+    train_set = TextMelDataset(hparams.training_audiopaths_and_text, *dataset_args)
+    val_set = TextMelDataset(hparams.val_audiopaths_and_text, *dataset_args)
+    # NOTE: the store is keyed by the feature config only, so training and
+    # validation clips have to go into a single store.
+    train_set.audiopaths_and_text = (
+        train_set.audiopaths_and_text + val_set.audiopaths_and_text
+    )
+    return train_set.build_feature_store(out)
+
+# Cell
+try:
+    from nbdev.imports import IN_NOTEBOOK
+except:
+    IN_NOTEBOOK = False
+if __name__ == "__main__" and not IN_NOTEBOOK:
+    args = parse_args(sys.argv[1:])
+    config = MELLOTRON_DEFAULTS.values()
+    if args.config:
+        with open(args.config) as f:
+            config.update(json.load(f))
+    hparams = HParams(**config)
+    out = args.out or getattr(hparams, "feature_store_path", None)
+    if not out:
+        raise Exception("Pass --out or set feature_store_path in the config")
+    store_path = build_feature_store(hparams, out)
+    print(f"Wrote feature store to {store_path}")
\ No newline at end of file
@@ -0,0 +1,42 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/exec.build_manifest.ipynb (unless otherwise specified).
+
+__all__ = ['parse_args', 'build_manifest']
+
+# Cell
+import argparse
+import sys
+
+from ..data.manifest import WavManifest
+from ..utils.utils import load_filepaths_and_text
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--filelist", nargs="+", required=True, help="Paths to filelists"
+    )
+    parser.add_argument("--out", required=True, help="Path to the manifest (.npz)")
+    parser.add_argument(
+        "--num-workers", type=int, default=16, help="Threads for reading headers"
+    )
+    args = parser.parse_args(args)
+    return args
+
+
+def build_manifest(filelists, out, num_workers=16):
+    audio_paths = []
+    for filelist in filelists:
+        audio_paths.extend(load_filepaths_and_text(filelist, columnar=True).column(0))
+    manifest = WavManifest(out)
+    n_read = manifest.update(audio_paths, num_workers=num_workers)
+    print(f"Read {n_read} headers, {len(manifest)} clips in {out}")
+    return manifest
+
+# Cell
+try:
+    from nbdev.imports import IN_NOTEBOOK
+except:
+    IN_NOTEBOOK = False
+if __name__ == "__main__" and not IN_NOTEBOOK:
+    args = parse_args(sys.argv[1:])
+    build_manifest(args.filelist, args.out, num_workers=args.num_workers)
\ No newline at end of file
@@ -0,0 +1,74 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/exec.pack_shards.ipynb (unless otherwise specified).
+
+__all__ = ['parse_args', 'pack_shards']
+
+# Cell
+import argparse
+import json
+import librosa  # NOTE(zach): importing torch before librosa causes LLVM issues for some unknown reason.
+import sys
+
+from ..data.feature_store import DEFAULT_SHARD_SIZE
+from ..data.shards import ShardWriter
+from ..data_loader import TextMelDataset
+from ..models.mellotron import DEFAULTS as MELLOTRON_DEFAULTS
+from ..utils.utils import load_filepaths_and_text
+from ..vendor.tfcompat.hparam import HParams
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filelist", required=True, help="Path to filelist")
+    parser.add_argument("--out", required=True, help="Shard directory")
+    parser.add_argument(
+        "--config", help="Tacotron2 JSON config. If set, mels are packed too."
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=DEFAULT_SHARD_SIZE,
+        help="Approximate shard size in bytes",
+    )
+    args = parser.parse_args(args)
+    return args
+
+
+def pack_shards(filelist, out, hparams=None, max_shard_size=DEFAULT_SHARD_SIZE):
+    if hparams is not None:
+        dataset = TextMelDataset(
+            filelist,
+            hparams.text_cleaners,
+            hparams.p_arpabet,
+            # audio params
+            hparams.n_mel_channels,
+            hparams.sampling_rate,
+            hparams.mel_fmin,
+            hparams.mel_fmax,
+            hparams.filter_length,
+            hparams.hop_length,
+            hparams.win_length,
+            hparams.max_wav_value,
+            hparams.include_f0,
+            hparams.pos_weight,
+        )
+        return dataset.pack_shards(out, max_shard_size=max_shard_size)
+    writer = ShardWriter(out, max_shard_size=max_shard_size)
+    for path, text, sid in load_filepaths_and_text(filelist):
+        writer.add(path, text, sid)
+    return writer.close()
+
+# Cell
+try:
+    from nbdev.imports import IN_NOTEBOOK
+except:
+    IN_NOTEBOOK = False
+if __name__ == "__main__" and not IN_NOTEBOOK:
+    args = parse_args(sys.argv[1:])
+    hparams = None
+    if args.config:
+        config = MELLOTRON_DEFAULTS.values()
+        with open(args.config) as f:
+            config.update(json.load(f))
+        hparams = HParams(**config)
+    out = pack_shards(args.filelist, args.out, hparams, args.shard_size)
+    print(f"Wrote shards to {out}")
\ No newline at end of file
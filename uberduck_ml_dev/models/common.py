@@ -1,10 +1,13 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/models.common.ipynb (unless otherwise specified).
 
-__all__ = ['Conv1d', 'LinearNorm', 'LocationLayer', 'Attention', 'STFT', 'MelSTFT', 'ReferenceEncoder',
-           'MultiHeadAttention', 'STL', 'GST', 'LayerNorm', 'Flip', 'Log', 'ElementwiseAffine', 'DDSConv', 'ConvFlow',
-           'WN', 'ResidualCouplingLayer', 'ResBlock1', 'ResBlock2', 'LRELU_SLOPE']
+__all__ = ['Conv1d', 'LinearNorm', 'LocationLayer', 'Attention', 'STFT', 'STFT_BACKENDS', 'mel_bands', 'MelSTFT',
+           'StreamingMelSTFT', 'get_stft', 'get_mel_stft', 'ReferenceEncoder', 'MultiHeadAttention', 'STL', 'GST',
+           'LayerNorm', 'Flip', 'Log', 'ElementwiseAffine', 'DDSConv', 'ConvFlow', 'WN', 'ResidualCouplingLayer',
+           'ResBlock1', 'ResBlock2', 'LRELU_SLOPE']
 
 # Cell
+import inspect
+
 from librosa.filters import mel as librosa_mel
 from librosa.util import pad_center, tiny
 import numpy as np
@@ -76,6 +79,7 @@ class LocationLayer(nn.Module):
     def __init__(self, attention_n_filters, attention_kernel_size, attention_dim):
         super(LocationLayer, self).__init__()
         padding = int((attention_kernel_size - 1) / 2)
+        self.padding = padding
         self.location_conv = Conv1d(
             2,
             attention_n_filters,
@@ -97,6 +101,13 @@ class LocationLayer(nn.Module):
 
 
 class Attention(nn.Module):
+    """Location-sensitive attention.
+
+    With window set, energies are only computed for the window encoder
+    positions either side of the previous attention peak, falling back to
+    full attention for rows where that loses the peak. See windowed_attention.
+    """
+
     def __init__(
         self,
         attention_rnn_dim,
@@ -105,8 +116,10 @@ class Attention(nn.Module):
         attention_location_n_filters,
         attention_location_kernel_size,
         fp16_run,
+        window=None,
     ):
         super(Attention, self).__init__()
+        self.window = window
         self.query_layer = LinearNorm(
             attention_rnn_dim, attention_dim, bias=False, w_init_gain="tanh"
         )
@@ -162,23 +175,136 @@ class Attention(nn.Module):
         attention_weights_cat: previous and cummulative attention weights
         mask: binary mask for padded data
         """
+        if (
+            attention_weights is None
+            and self.window is not None
+            and 2 * self.window + 1 < memory.size(1)
+        ):
+            return self.windowed_attention(
+                attention_hidden_state,
+                memory,
+                processed_memory,
+                attention_weights_cat,
+                mask,
+            )
         if attention_weights is None:
-            alignment = self.get_alignment_energies(
-                attention_hidden_state, processed_memory, attention_weights_cat
+            attention_weights = self._full_attention_weights(
+                attention_hidden_state, processed_memory, attention_weights_cat, mask
             )
-
-            if mask is not None:
-                alignment.data.masked_fill_(mask, self.score_mask_value)
-
-            attention_weights = F.softmax(alignment, dim=1)
         attention_context = torch.bmm(attention_weights.unsqueeze(1), memory)
         attention_context = attention_context.squeeze(1)
 
         return attention_context, attention_weights
 
+    def _full_attention_weights(
+        self, query, processed_memory, attention_weights_cat, mask
+    ):
+        alignment = self.get_alignment_energies(
+            query, processed_memory, attention_weights_cat
+        )
+
+        if mask is not None:
+            alignment.data.masked_fill_(mask, self.score_mask_value)
+
+        return F.softmax(alignment, dim=1)
+
+    def windowed_attention(
+        self, query, memory, processed_memory, attention_weights_cat, mask
+    ):
+        """Attend over the 2 * window + 1 encoder positions around the peak of
+        the previous attention weights, at a cost that doesn't depend on the
+        encoder length.
+
+        Only that slice of processed_memory and of the location features is
+        computed. Rows whose new peak is at an edge of the window, and so may
+        really be outside it, fall back to full attention, which is computed
+        for those rows only. Finding them reads a flag on the host, so this
+        syncs with the device once per step.
+        """
+        context, weights, lost = self._attend_window(
+            query, memory, processed_memory, attention_weights_cat, mask, self.window
+        )
+        if lost.any():
+            rows = lost.nonzero(as_tuple=True)[0]
+            full_weights = self._full_attention_weights(
+                query[rows],
+                processed_memory[rows],
+                attention_weights_cat[rows],
+                None if mask is None else mask[rows],
+            )
+            weights[rows] = full_weights
+            context[rows] = torch.bmm(full_weights.unsqueeze(1), memory[rows]).squeeze(
+                1
+            )
+        return context, weights
+
+    def _attend_window(
+        self, query, memory, processed_memory, attention_weights_cat, mask, window
+    ):
+        """Attention restricted to the 2 * window + 1 positions around the
+        previous peak. Also returns whether each row's new peak is at an inner
+        edge of the window."""
+        B, _, max_time = attention_weights_cat.shape
+        n_positions = 2 * window + 1
+        pad = self.location_layer.padding
+        center = attention_weights_cat[:, 0].argmax(1)
+        start = (center - window).clamp(0, max_time - n_positions)
+        offsets = torch.arange(n_positions + 2 * pad, device=memory.device)
+        # The window plus enough previous weights either side for the location
+        # convolution, zero outside the sequence like the convolution's padding.
+        halo = start[:, None] - pad + offsets
+        inside = (halo >= 0) & (halo < max_time)
+        weights_cat = attention_weights_cat.gather(
+            2, halo.clamp(0, max_time - 1)[:, None].expand(-1, 2, -1)
+        )
+        weights_cat = weights_cat * inside[:, None]
+        processed_attention = self.location_layer(weights_cat)[
+            :, pad : pad + n_positions
+        ]
+
+        positions = halo[:, pad : pad + n_positions]
+        window_memory = processed_memory.gather(
+            1, positions[:, :, None].expand(-1, -1, processed_memory.size(2))
+        )
+        processed_query = self.query_layer(query.unsqueeze(1))
+        alignment = self.v(
+            torch.tanh(processed_query + processed_attention + window_memory)
+        ).squeeze(-1)
+        if mask is not None:
+            alignment.data.masked_fill_(
+                mask.gather(1, positions), self.score_mask_value
+            )
+        window_weights = F.softmax(alignment, dim=1)
+
+        peak = window_weights.argmax(1)
+        lost = ((peak == 0) & (start > 0)) | (
+            (peak == n_positions - 1) & (start < max_time - n_positions)
+        )
+
+        attention_context = torch.bmm(
+            window_weights.unsqueeze(1),
+            memory.gather(1, positions[:, :, None].expand(-1, -1, memory.size(2))),
+        ).squeeze(1)
+        attention_weights = torch.zeros_like(attention_weights_cat[:, 0]).scatter(
+            1, positions, window_weights
+        )
+        return attention_context, attention_weights, lost
+
 # Cell
+from collections import OrderedDict
+
+STFT_BACKENDS = ("conv", "fft")
+
+
 class STFT:
-    """adapted from Prem Seetharaman's https://github.com/pseeth/pytorch-stft"""
+    """adapted from Prem Seetharaman's https://github.com/pseeth/pytorch-stft
+
+    backend selects how transform computes the forward STFT: "conv" convolves
+    with the windowed Fourier basis, "fft" calls torch.stft. Both give the
+    same frames; "fft" is faster, especially for long inputs.
+    """
+
+    envelope_cache_size = 32
 
     def __init__(
         self,
@@ -189,56 +315,68 @@ class STFT:
         padding=None,
         device="cpu",
         rank=None,
+        backend="conv",
     ):
+        if backend not in STFT_BACKENDS:
+            raise ValueError(f"STFT backend must be one of {STFT_BACKENDS}")
+        self.backend = backend
+        self._window_envelopes = OrderedDict()
         self.filter_length = filter_length
         self.hop_length = hop_length
         self.win_length = win_length
         self.window = window
         self.forward_transform = None
-        scale = self.filter_length / self.hop_length
-        fourier_basis = np.fft.fft(np.eye(self.filter_length))
-
         self.padding = padding or (filter_length // 2)
-
-        cutoff = int((self.filter_length / 2 + 1))
-        fourier_basis = np.vstack(
-            [np.real(fourier_basis[:cutoff, :]), np.imag(fourier_basis[:cutoff, :])]
-        )
-
         if device == "cuda":
-            dev = torch.device(f"cuda:{rank}")
-            forward_basis = torch.cuda.FloatTensor(
-                fourier_basis[:, None, :], device=dev
-            )
-            inverse_basis = torch.cuda.FloatTensor(
-                np.linalg.pinv(scale * fourier_basis).T[:, None, :].astype(np.float32),
-                device=dev,
-            )
+            self.device = torch.device("cuda" if rank is None else f"cuda:{rank}")
         else:
-            forward_basis = torch.FloatTensor(fourier_basis[:, None, :])
-            inverse_basis = torch.FloatTensor(
-                np.linalg.pinv(scale * fourier_basis).T[:, None, :].astype(np.float32)
-            )
+            self.device = torch.device(device)
+        # NOTE: the Fourier bases are built on first use, since the fft
+        # backend never needs the forward basis and only inversion needs the
+        # (slow to compute) inverse one.
+        self._forward_basis = None
+        self._inverse_basis = None
 
         if window is not None:
             assert filter_length >= win_length
             # get window and zero center pad it to filter_length
             fft_window = get_window(window, win_length, fftbins=True)
             fft_window = pad_center(fft_window, filter_length)
-            fft_window = torch.from_numpy(fft_window).float()
+            self.fft_window = torch.from_numpy(fft_window).float().to(self.device)
 
-            if device == "cuda":
-                fft_window = fft_window.cuda(rank)
+    def _fourier_basis(self):
+        fourier_basis = np.fft.fft(np.eye(self.filter_length))
+        cutoff = int((self.filter_length / 2 + 1))
+        return np.vstack(
+            [np.real(fourier_basis[:cutoff, :]), np.imag(fourier_basis[:cutoff, :])]
+        )
 
+    def _windowed(self, basis):
+        basis = torch.from_numpy(basis[:, None, :].astype(np.float32)).to(self.device)
+        if self.window is not None:
             # window the bases
-            forward_basis *= fft_window
-            inverse_basis *= fft_window
-            self.fft_window = fft_window
-
-        self.forward_basis = forward_basis.float()
-        self.inverse_basis = inverse_basis.float()
-
-    def transform(self, input_data):
+            basis *= self.fft_window
+        return basis
+
+    @property
+    def forward_basis(self):
+        if self._forward_basis is None:
+            self._forward_basis = self._windowed(self._fourier_basis())
+        return self._forward_basis
+
+    @property
+    def inverse_basis(self):
+        if self._inverse_basis is None:
+            scale = self.filter_length / self.hop_length
+            inverse_basis = np.linalg.pinv(scale * self._fourier_basis()).T
+            self._inverse_basis = self._windowed(inverse_basis)
+        return self._inverse_basis
+
+    def transform(self, input_data, return_phase=True):
+        """Return the magnitude and phase of the STFT of input_data (B, T).
+
+        With return_phase=False the phase isn't computed and is returned as None.
+        """
         num_batches = input_data.size(0)
         num_samples = input_data.size(1)
 
@@ -256,7 +394,24 @@ class STFT:
             ),
             mode="reflect",
         )
-        input_data = input_data.squeeze(1)
+        return self.transform_padded(input_data.squeeze(1), return_phase)
+
+    def transform_padded(self, input_data, return_phase=True):
+        """transform for input_data (B, 1, T) that is already padded."""
+        if self.backend == "fft":
+            # NOTE: the window is already zero-padded to filter_length.
+            forward_transform = torch.stft(
+                input_data.squeeze(1),
+                self.filter_length,
+                hop_length=self.hop_length,
+                win_length=self.filter_length,
+                window=getattr(self, "fft_window", None),
+                center=False,
+                return_complex=True,
+            )
+            magnitude = forward_transform.abs()
+            phase = forward_transform.angle() if return_phase else None
+            return magnitude, phase
 
         forward_transform = F.conv1d(
             input_data,
@@ -270,6 +425,8 @@ class STFT:
         imag_part = forward_transform[:, cutoff:, :]
 
         magnitude = torch.sqrt(real_part ** 2 + imag_part ** 2)
+        if not return_phase:
+            return magnitude, None
         phase = torch.autograd.Variable(torch.atan2(imag_part.data, real_part.data))
 
         return magnitude, phase
@@ -288,34 +445,45 @@ class STFT:
         )
 
         if self.window is not None:
-            window_sum = window_sumsquare(
-                self.window,
-                magnitude.size(-1),
-                hop_length=self.hop_length,
-                win_length=self.win_length,
-                n_fft=self.filter_length,
-                dtype=np.float32,
-            )
-            # remove modulation effects
-            approx_nonzero_indices = torch.from_numpy(
-                np.where(window_sum > tiny(window_sum))[0]
-            )
-            window_sum = torch.autograd.Variable(
-                torch.from_numpy(window_sum), requires_grad=False
+            # remove modulation effects and scale by hop ratio
+            inverse_transform *= self._window_envelope(
+                magnitude.size(-1), inverse_transform.device
             )
-            window_sum = window_sum.cuda() if magnitude.is_cuda else window_sum
-            inverse_transform[:, :, approx_nonzero_indices] /= window_sum[
-                approx_nonzero_indices
-            ]
-
-            # scale by hop ratio
-            inverse_transform *= float(self.filter_length) / self.hop_length
 
         inverse_transform = inverse_transform[:, :, int(self.filter_length / 2) :]
         inverse_transform = inverse_transform[:, :, : -int(self.filter_length / 2) :]
 
         return inverse_transform
 
+    def _window_envelope(self, n_frames, device):
+        """Reciprocal of the window sum-square envelope, times the hop ratio.
+
+        Memoized per (n_frames, device) in an LRU of envelope_cache_size, so
+        repeated inversions (e.g. Griffin-Lim) do no host work.
+        """
+        key = (n_frames, device)
+        envelope = self._window_envelopes.get(key)
+        if envelope is not None:
+            self._window_envelopes.move_to_end(key)
+            return envelope
+        window_sum = window_sumsquare(
+            self.window,
+            n_frames,
+            hop_length=self.hop_length,
+            win_length=self.win_length,
+            n_fft=self.filter_length,
+            dtype=np.float32,
+        )
+        nonzero = window_sum > tiny(window_sum)
+        window_sum[nonzero] = 1 / window_sum[nonzero]
+        window_sum[~nonzero] = 1
+        window_sum *= float(self.filter_length) / self.hop_length
+        envelope = torch.from_numpy(window_sum).to(device)
+        self._window_envelopes[key] = envelope
+        if len(self._window_envelopes) > self.envelope_cache_size:
+            self._window_envelopes.popitem(last=False)
+        return envelope
+
     def forward(self, input_data):
         self.magnitude, self.phase = self.transform(input_data)
         reconstruction = self.inverse(self.magnitude, self.phase)
@@ -324,7 +492,33 @@ class STFT:
 # Cell
 
 
+def mel_bands(mel_basis, filters_per_band=16):
+    """Split mel_basis into bands of filters_per_band consecutive filters.
+
+    Each mel filter is only nonzero over a few neighbouring frequency bins, so
+    a band is returned as (start, end, block): the range of bins where any of
+    its filters is nonzero and the basis restricted to those bins.
+    """
+    nonzero = mel_basis != 0
+    bands = []
+    for row in range(0, mel_basis.size(0), filters_per_band):
+        bins = nonzero[row : row + filters_per_band].any(0).nonzero().flatten()
+        # A band of all-zero filters (possible with many narrow filters) is empty.
+        start, end = (bins[0].item(), bins[-1].item() + 1) if len(bins) else (0, 0)
+        block = mel_basis[row : row + filters_per_band, start:end].contiguous()
+        bands.append((start, end, block))
+    return bands
+
+
 class MelSTFT:
+    """Mel spectrograms from waveforms, and back with Griffin-Lim.
+
+    On the CPU the mel projection uses the banded form of the mel basis from
+    mel_bands when that skips more than 1 - max_banded_fraction of it.
+    """
+
+    max_banded_fraction = 0.5
+
     def __init__(
         self,
         filter_length=1024,
@@ -337,26 +531,33 @@ class MelSTFT:
         device="cpu",
         padding=None,
         rank=None,
+        stft_backend="conv",
     ):
         self.n_mel_channels = n_mel_channels
         self.sampling_rate = sampling_rate
         if padding is None:
             padding = filter_length // 2
-        self.stft_fn = STFT(
+        self.stft_fn = get_stft(
             filter_length,
             hop_length,
             win_length,
             device=device,
             rank=rank,
             padding=padding,
+            backend=stft_backend,
         )
         mel_basis = librosa_mel(
             sampling_rate, filter_length, n_mel_channels, mel_fmin, mel_fmax
         )
-        mel_basis = torch.from_numpy(mel_basis).float()
-        if device == "cuda":
-            mel_basis = mel_basis.cuda()
-        self.mel_basis = mel_basis
+        self.mel_basis = torch.from_numpy(mel_basis).float().to(self.stft_fn.device)
+        self.mel_bands = mel_bands(self.mel_basis)
+        # NOTE: the banded projection is a handful of small matmuls, which
+        # only pays off on the CPU, and only if it skips most of the basis.
+        banded_size = sum(block.numel() for _, _, block in self.mel_bands)
+        self.banded = (
+            self.stft_fn.device.type == "cpu"
+            and banded_size < self.mel_basis.numel() * self.max_banded_fraction
+        )
 
     def spectral_normalize(self, magnitudes):
         output = dynamic_range_compression(magnitudes)
@@ -367,14 +568,23 @@ class MelSTFT:
         return output
 
     def spec_to_mel(self, spec):
-        mel_output = torch.matmul(self.mel_basis, spec)
+        if self.banded:
+            mel_output = torch.cat(
+                [
+                    torch.matmul(block, spec[..., start:end, :])
+                    for start, end, block in self.mel_bands
+                ],
+                dim=-2,
+            )
+        else:
+            mel_output = torch.matmul(self.mel_basis, spec)
         mel_output = self.spectral_normalize(mel_output)
         return mel_output
 
     def spectrogram(self, y):
         assert y.min() >= -1
         assert y.max() <= 1
-        magnitudes, phases = self.stft_fn.transform(y)
+        magnitudes, _ = self.stft_fn.transform(y, return_phase=False)
         return magnitudes.data
 
     def mel_spectrogram(self, y, ref_level_db=20, magnitude_power=1.5):
@@ -390,19 +600,139 @@ class MelSTFT:
         assert y.min() >= -1
         assert y.max() <= 1
 
-        magnitudes, phases = self.stft_fn.transform(y)
+        magnitudes, _ = self.stft_fn.transform(y, return_phase=False)
         magnitudes = magnitudes.data
         return self.spec_to_mel(magnitudes)
 
-    def griffin_lim(self, mel_spectrogram, n_iters=30):
+    def stream_mel_spectrogram(self, blocks):
+        """Yield the mel spectrogram of a signal given as consecutive blocks of
+        samples, in chunks of frames (n_mel_channels, n). The chunks concatenate
+        to the mel_spectrogram of the whole signal. See StreamingMelSTFT."""
+        stream = StreamingMelSTFT(self)
+        for block in blocks:
+            mel = stream.feed(block)
+            if mel.size(-1):
+                yield mel
+        mel = stream.flush()
+        if mel.size(-1):
+            yield mel
+
+    def griffin_lim(self, mel_spectrogram, n_iters=30, lengths=None, **kwargs):
+        """Vocode a mel spectrogram (n_mel_channels, T), or a padded batch of
+        them (B, n_mel_channels, T) with their lengths in frames. Runs on this
+        module's device. kwargs (momentum, tol) are passed to griffin_lim."""
+        squeeze = mel_spectrogram.dim() == 2
+        if squeeze:
+            mel_spectrogram = mel_spectrogram.unsqueeze(0)
         mel_dec = self.spectral_de_normalize(mel_spectrogram)
         # Float cast required for fp16 training.
-        mel_dec = mel_dec.transpose(0, 1).cpu().data.float()
-        spec_from_mel = torch.mm(mel_dec, self.mel_basis).transpose(0, 1)
+        mel_dec = mel_dec.to(self.mel_basis.device).data.float()
+        if self.banded:
+            spec_from_mel = mel_dec.new_zeros(
+                mel_dec.shape[:-2] + (self.mel_basis.size(1), mel_dec.size(-1))
+            )
+            row = 0
+            for start, end, block in self.mel_bands:
+                rows = mel_dec[..., row : row + block.size(0), :]
+                spec_from_mel[..., start:end, :] += torch.matmul(block.t(), rows)
+                row += block.size(0)
+        else:
+            spec_from_mel = torch.matmul(self.mel_basis.transpose(0, 1), mel_dec)
         spec_from_mel *= 1000
-        out = griffin_lim(spec_from_mel.unsqueeze(0), self.stft_fn, n_iters=n_iters)
+        out = griffin_lim(
+            spec_from_mel, self.stft_fn, n_iters=n_iters, lengths=lengths, **kwargs
+        )
+        if squeeze:
+            # Keep the (1, n_samples) shape of a single spectrogram.
+            return out[:1]
         return out
 
+
+class StreamingMelSTFT:
+    """Mel spectrogram of a signal that arrives in blocks.
+
+    feed takes the next block of samples (T,) and returns the mel frames
+    (n_mel_channels, n) it completes; flush ends the signal and returns the
+    rest. Between calls only the samples of the next, incomplete frame are
+    kept, so memory doesn't grow with the length of the signal. The frames are
+    the same as those of mel_stft.mel_spectrogram on the whole signal,
+    including its reflect padding at both ends.
+    """
+
+    def __init__(self, mel_stft):
+        self.mel_stft = mel_stft
+        self.stft_fn = mel_stft.stft_fn
+        self._reset()
+
+    def _reset(self):
+        # Padded signal whose frames haven't been computed yet.
+        self._buffer = torch.empty(0, device=self.stft_fn.device)
+        # The last padding + 1 samples, to reflect at the end of the signal.
+        self._tail = self._buffer
+        self._started = False
+
+    def _frames(self):
+        filter_length = self.stft_fn.filter_length
+        hop_length = self.stft_fn.hop_length
+        n_frames = max(0, (self._buffer.size(0) - filter_length) // hop_length + 1)
+        if n_frames == 0:
+            return self._buffer.new_zeros(self.mel_stft.n_mel_channels, 0)
+        used = self._buffer[: (n_frames - 1) * hop_length + filter_length]
+        magnitudes, _ = self.stft_fn.transform_padded(
+            used.view(1, 1, -1), return_phase=False
+        )
+        self._buffer = self._buffer[n_frames * hop_length :]
+        return self.mel_stft.spec_to_mel(magnitudes.data)[0]
+
+    def feed(self, block):
+        assert block.min() >= -1
+        assert block.max() <= 1
+        padding = self.stft_fn.padding
+        block = block.to(self.stft_fn.device)
+        self._buffer = torch.cat([self._buffer, block])
+        self._tail = torch.cat([self._tail, block])[-(padding + 1) :]
+        if not self._started and self._buffer.size(0) > padding:
+            reflection = self._buffer[1 : padding + 1].flip(0)
+            self._buffer = torch.cat([reflection, self._buffer])
+            self._started = True
+        return self._frames()
+
+    def flush(self):
+        if not self._started:
+            raise ValueError(
+                f"Signal of {self._buffer.size(0)} samples is too short to pad by {self.stft_fn.padding}"
+            )
+        reflection = self._tail[:-1].flip(0)
+        self._buffer = torch.cat([self._buffer, reflection])
+        mel = self._frames()
+        self._reset()
+        return mel
+
+
+_stfts = {}
+
+
+def _shared(cls, *args, **kwargs):
+    signature = inspect.signature(cls)
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    key = (cls,) + tuple(bound.arguments.items())
+    if key not in _stfts:
+        _stfts[key] = cls(*bound.args, **bound.kwargs)
+    return _stfts[key]
+
+
+def get_stft(*args, **kwargs):
+    """Return the STFT for these arguments, built on the first call and shared
+    by every later call with the same configuration and device."""
+    return _shared(STFT, *args, **kwargs)
+
+
+def get_mel_stft(*args, **kwargs):
+    """Return the MelSTFT for these arguments, built on the first call and
+    shared by every later call with the same configuration and device."""
+    return _shared(MelSTFT, *args, **kwargs)
+
 # Cell
 from torch.nn import init
 
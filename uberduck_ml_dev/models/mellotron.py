@@ -40,7 +40,10 @@ DEFAULTS = HParams(
     prenet_rms_dim=0,
     prenet_fms_kernel_size=1,
     max_decoder_steps=1000,
+    max_frames_per_token=None,
     gate_threshold=0.5,
+    stop_check_interval=1,
+    attention_stop=False,
     p_attention_dropout=0.1,
     p_decoder_dropout=0.1,
     p_teacher_forcing=1.0,
@@ -48,6 +51,7 @@ DEFAULTS = HParams(
     # attention parameters
     attention_rnn_dim=1024,
     attention_dim=128,
+    attention_window=None,
     # location layer parameters
     attention_location_n_filters=32,
     attention_location_kernel_size=31,
@@ -83,6 +87,10 @@ class Postnet(nn.Module):
     def __init__(self, hparams):
         super(Postnet, self).__init__()
         self.dropout_rate = 0.5
+        # Frames on either side of an output frame that it depends on.
+        self.context = (
+            hparams.postnet_n_convolutions * (hparams.postnet_kernel_size - 1) // 2
+        )
         self.convolutions = nn.ModuleList()
 
         self.convolutions.append(
@@ -131,11 +139,17 @@ class Postnet(nn.Module):
             )
         )
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
+        """With lengths, each row of a padded batch x is processed as if it
+        were unpadded, i.e. as if its frames were followed by zeros."""
+        if lengths is not None:
+            mask = get_mask_from_lengths(lengths, x.size(2)).unsqueeze(1)
         for i in range(len(self.convolutions) - 1):
             x = F.dropout(
                 torch.tanh(self.convolutions[i](x)), self.dropout_rate, self.training
             )
+            if lengths is not None:
+                x = x.masked_fill(~mask, 0.0)
         x = F.dropout(self.convolutions[-1](x), self.dropout_rate, self.training)
 
         return x
@@ -223,21 +237,49 @@ class Encoder(nn.Module):
         outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs, batch_first=True)
         return outputs
 
-    def inference(self, x):
+    def inference(self, x, input_lengths=None):
+        """Encode x (B, encoder_embedding_dim, T). For a padded batch, pass
+        input_lengths: each row is then encoded as if it were unpadded."""
+        if input_lengths is not None:
+            mask = get_mask_from_lengths(input_lengths, x.size(2)).unsqueeze(1)
         for conv in self.convolutions:
+            if input_lengths is not None:
+                # NOTE: zero the padding so the convolutions see the same
+                # zero padding past the end of each row as an unpadded input.
+                x = x.masked_fill(~mask, 0.0)
             x = F.dropout(F.relu(conv(x)), self.dropout_rate, self.training)
 
         x = x.transpose(1, 2)
 
         self.lstm.flatten_parameters()
-        outputs, _ = self.lstm(x)
+        if input_lengths is None:
+            outputs, _ = self.lstm(x)
+            return outputs
 
+        x = nn.utils.rnn.pack_padded_sequence(
+            x, input_lengths.cpu(), batch_first=True, enforce_sorted=False
+        )
+        outputs, _ = self.lstm(x)
+        outputs, _ = nn.utils.rnn.pad_packed_sequence(
+            outputs, batch_first=True, total_length=mask.size(2)
+        )
         return outputs
 
 # Cell
 
 
+def _grow_steps(buffer, n_steps):
+    """Copy buffer (B, steps, ...) into a new buffer with room for n_steps."""
+    grown = buffer.new_empty(buffer.size(0), n_steps, *buffer.shape[2:])
+    grown[:, : buffer.size(1)] = buffer
+    return grown
+
+
 class Decoder(nn.Module):
+    # Steps of output to allocate for inference up front. The buffers double
+    # in size whenever they fill up, so decoding takes linear time.
+    inference_buffer_steps = 256
+
     def __init__(self, hparams):
         super().__init__()
         self.n_mel_channels = hparams.n_mel_channels
@@ -252,7 +294,10 @@ class Decoder(nn.Module):
         self.decoder_rnn_dim = hparams.decoder_rnn_dim
         self.prenet_dim = hparams.prenet_dim
         self.max_decoder_steps = hparams.max_decoder_steps
+        self.max_frames_per_token = getattr(hparams, "max_frames_per_token", None)
         self.gate_threshold = hparams.gate_threshold
+        self.stop_check_interval = getattr(hparams, "stop_check_interval", 1)
+        self.attention_stop = getattr(hparams, "attention_stop", False)
         self.p_attention_dropout = hparams.p_attention_dropout
         self.p_decoder_dropout = hparams.p_decoder_dropout
         self.p_teacher_forcing = hparams.p_teacher_forcing
@@ -289,6 +334,7 @@ class Decoder(nn.Module):
             hparams.attention_location_n_filters,
             hparams.attention_location_kernel_size,
             fp16_run=hparams.fp16_run,
+            window=getattr(hparams, "attention_window", None),
         )
 
         self.decoder_rnn = nn.LSTMCell(
@@ -417,6 +463,29 @@ class Decoder(nn.Module):
 
         return mel_outputs, gate_outputs, alignments
 
+    def parse_inference_outputs(self, mel_outputs, gate_outputs, alignments, n_steps):
+        """parse_decoder_outputs for the first n_steps steps of the output
+        buffers filled during inference
+        PARAMS
+        ------
+        mel_outputs: (B, max_steps, n_mel_channels * n_frames_per_step)
+        gate_outputs: (B, max_steps)
+        alignments: (B, max_steps, T_in)
+
+        RETURNS
+        -------
+        mel_outputs: (B, n_mel_channels, n_steps * n_frames_per_step)
+        gate_outputs: (B, n_steps * n_frames_per_step)
+        alignments: (B, n_steps, T_in)
+        """
+        B = mel_outputs.size(0)
+        mel_outputs = mel_outputs[:, :n_steps].reshape(B, -1, self.n_mel_channels)
+        mel_outputs = mel_outputs.transpose(1, 2)
+        gate_outputs = gate_outputs[:, :n_steps].repeat_interleave(
+            self.n_frames_per_step_current, dim=1
+        )
+        return mel_outputs, gate_outputs, alignments[:, :n_steps]
+
     def decode(self, decoder_input, attention_weights=None):
         """Decoder step using stored states, attention and memory
         PARAMS
@@ -569,20 +638,56 @@ class Decoder(nn.Module):
 
         return mel_outputs, gate_outputs, alignments
 
-    def inference(self, memory, f0s=None):
+    def inference(self, memory, f0s=None, memory_lengths=None):
         """Decoder inference
         PARAMS
         ------
         memory: Encoder outputs
+        memory_lengths: Encoder output lengths for attention masking, for a
+            padded batch.
+
+        Each row stops when its gate fires, when its attention reaches the last
+        encoder position if attention_stop is set, or when it runs out of steps:
+        max_decoder_steps, and max_frames_per_token frames per encoder position
+        if set. Whether every row has stopped is only checked every
+        stop_check_interval steps, to spare a device sync per step; the outputs
+        don't depend on it. Frames past the end of a row are zeroed.
 
         RETURNS
         -------
         mel_outputs: mel outputs from the decoder
         gate_outputs: gate outputs from the decoder
         alignments: sequence of attention weights from the decoder
+        mel_lengths: number of frames decoded for each row
+        """
+        for outputs in self.inference_steps(memory, f0s, memory_lengths):
+            pass
+        _, mel_outputs, gate_outputs, alignments, mel_lengths, _ = outputs
+
+        # Steps decoded after every row had finished (and before that was
+        # checked) are dropped.
+        step = -(-int(mel_lengths.max()) // self.n_frames_per_step_current)
+        mel_outputs, gate_outputs, alignments = self.parse_inference_outputs(
+            mel_outputs, gate_outputs, alignments, step
+        )
+        mel_mask = get_mask_from_lengths(mel_lengths, mel_outputs.size(2))
+        mel_outputs = mel_outputs.masked_fill(~mel_mask.unsqueeze(1), 0.0)
+
+        return mel_outputs, gate_outputs, alignments, mel_lengths
+
+    def inference_steps(self, memory, f0s=None, memory_lengths=None):
+        """The decoding loop of inference, as a generator that yields
+        (step, mel_outputs, gate_outputs, alignments, mel_lengths, finished)
+        after each decoder step. The outputs are buffers of shape
+        (B, n_steps, ...) in which only the first step steps are filled, and
+        may be reallocated as decoding goes on; mel_lengths and finished are
+        updated in place. Frames past the end of a row are not zeroed.
         """
         decoder_input = self.get_go_frame(memory)
-        self.initialize_decoder_states(memory, mask=None)
+        mask = None
+        if memory_lengths is not None:
+            mask = ~get_mask_from_lengths(memory_lengths, memory.size(1))
+        self.initialize_decoder_states(memory, mask=mask)
         if f0s is not None:
             f0_dummy = self.get_end_f0(f0s)
             f0s = torch.cat((f0s, f0_dummy), dim=2)
@@ -590,12 +695,30 @@ class Decoder(nn.Module):
             f0s = f0s.permute(2, 0, 1)
 
         B = memory.size(0)
-        mel_outputs = torch.empty(
-            B, 0, self.n_frames_per_step_current * self.n_mel_channels
-        )
-        if torch.cuda.is_available():
-            mel_outputs = mel_outputs.cuda()
-        gate_outputs, alignments = [], []
+        if memory_lengths is None:
+            memory_lengths = torch.full(
+                (B,), memory.size(1), dtype=torch.long, device=memory.device
+            )
+        max_steps = torch.full_like(memory_lengths, self.max_decoder_steps)
+        if self.max_frames_per_token is not None:
+            token_steps = torch.ceil(
+                memory_lengths
+                * self.max_frames_per_token
+                / self.n_frames_per_step_current
+            ).long()
+            max_steps = torch.minimum(max_steps, token_steps.clamp(min=1))
+        n_max_steps = int(max_steps.max())
+
+        frame_size = self.n_frames_per_step_current * self.n_mel_channels
+        n_steps = min(self.inference_buffer_steps, n_max_steps)
+        mel_outputs = memory.new_empty(B, n_steps, frame_size)
+        gate_outputs = memory.new_empty(B, n_steps)
+        alignments = memory.new_empty(B, n_steps, memory.size(1))
+        step = 0
+        mel_lengths = torch.zeros(B, dtype=torch.long, device=memory.device)
+        # Rows whose gate or attention said to stop, and rows that are done.
+        stopped = torch.zeros(B, dtype=torch.bool, device=memory.device)
+        finished = torch.zeros_like(stopped)
         while True:
             f0 = None
             if f0s is not None:
@@ -611,27 +734,31 @@ class Decoder(nn.Module):
 
             decoder_input = torch.cat(to_cat, dim=1)
             mel_output, gate_output, alignment = self.decode(decoder_input)
-            mel_output = mel_output[
-                :, 0 : self.n_mel_channels * self.n_frames_per_step_current
-            ].unsqueeze(1)
 
-            mel_outputs = torch.cat([mel_outputs, mel_output], dim=1)
-            gate_outputs += [gate_output.squeeze()] * self.n_frames_per_step_current
-            alignments += [alignment]
-
-            if torch.sigmoid(gate_output.data) > self.gate_threshold:
+            if step == mel_outputs.size(1):
+                n_steps = min(2 * step, n_max_steps)
+                mel_outputs = _grow_steps(mel_outputs, n_steps)
+                gate_outputs = _grow_steps(gate_outputs, n_steps)
+                alignments = _grow_steps(alignments, n_steps)
+            mel_outputs[:, step] = mel_output[:, :frame_size]
+            gate_outputs[:, step] = gate_output[:, 0]
+            alignments[:, step] = alignment
+            step += 1
+
+            mel_lengths += (~finished).long() * self.n_frames_per_step_current
+            stopped |= torch.sigmoid(gate_output.data.squeeze(1)) > self.gate_threshold
+            if self.attention_stop:
+                stopped |= alignment.data.argmax(1) >= memory_lengths - 1
+            finished |= stopped | (step >= max_steps)
+            yield step, mel_outputs, gate_outputs, alignments, mel_lengths, finished
+            if step == n_max_steps:
+                if not stopped.all():
+                    print("Warning! Reached max decoder steps")
                 break
-            elif mel_outputs.size(1) == self.max_decoder_steps:
-                print("Warning! Reached max decoder steps")
+            if step % self.stop_check_interval == 0 and finished.all():
                 break
 
-            decoder_input = mel_output[:, -1, -1 * self.n_mel_channels :]
-
-        mel_outputs, gate_outputs, alignments = self.parse_decoder_outputs(
-            mel_outputs, gate_outputs, alignments
-        )
-
-        return mel_outputs, gate_outputs, alignments
+            decoder_input = mel_outputs[:, step - 1, -1 * self.n_mel_channels :]
 
     def inference_noattention(self, memory, f0s, attention_map):
         """Decoder inference
@@ -654,30 +781,25 @@ class Decoder(nn.Module):
         f0s = f0s.permute(2, 0, 1)
 
         B = memory.size(0)
-        mel_outputs = torch.empty(
-            B, 0, self.n_frames_per_step_current * self.n_mel_channels
-        )
-        if torch.cuda.is_available():
-            mel_outputs = mel_outputs.cuda()
-        gate_outputs, alignments = [], []
-        for i in range(len(attention_map)):
+        frame_size = self.n_frames_per_step_current * self.n_mel_channels
+        n_steps = len(attention_map)
+        mel_outputs = memory.new_empty(B, n_steps, frame_size)
+        gate_outputs = memory.new_empty(B, n_steps)
+        alignments = memory.new_empty(B, n_steps, memory.size(1))
+        for i in range(n_steps):
             f0 = f0s[i]
             attention = attention_map[i]
             decoder_input = torch.cat((self.prenet(decoder_input), f0), dim=1)
             mel_output, gate_output, alignment = self.decode(decoder_input, attention)
             mel_output, gate_output, alignment = self.decode(decoder_input)
-            mel_output = mel_output[
-                :, 0 : self.n_mel_channels * self.n_frames_per_step_current
-            ].unsqueeze(1)
-
-            mel_outputs = torch.cat([mel_outputs, mel_output], dim=1)
-            gate_outputs += [gate_output.squeeze()] * self.n_frames_per_step_current
-            alignments += [alignment]
+            mel_outputs[:, i] = mel_output[:, :frame_size]
+            gate_outputs[:, i] = gate_output[:, 0]
+            alignments[:, i] = alignment
 
-            decoder_input = mel_output[:, -1, -1 * self.n_mel_channels :]
+            decoder_input = mel_outputs[:, i, -1 * self.n_mel_channels :]
 
-        mel_outputs, gate_outputs, alignments = self.parse_decoder_outputs(
-            mel_outputs, gate_outputs, alignments
+        mel_outputs, gate_outputs, alignments = self.parse_inference_outputs(
+            mel_outputs, gate_outputs, alignments, n_steps
         )
 
         return mel_outputs, gate_outputs, alignments
@@ -796,14 +918,10 @@ class Tacotron2(TTSModel):
             [mel_outputs, mel_outputs_postnet, gate_outputs, alignments], output_lengths
         )
 
-    def inference(self, inputs):
-        text, style_input, speaker_ids, *_ = inputs
-        if self.include_f0:
-            f0s = inputs[3]
-        else:
-            f0s = None
+    def _inference_memory(self, text, style_input, speaker_ids, input_lengths=None):
         embedded_inputs = self.embedding(text).transpose(1, 2)
-        embedded_text = self.encoder.inference(embedded_inputs)
+        embedded_text = self.encoder.inference(embedded_inputs, input_lengths)
+        B, T = embedded_text.shape[:2]
         embedded_speakers = self.speaker_embedding(speaker_ids)[:, None]
         if hasattr(self, "gst"):
             if isinstance(style_input, int):
@@ -816,26 +934,124 @@ class Tacotron2(TTSModel):
             else:
                 embedded_gst = self.gst(style_input)
 
-        embedded_speakers = embedded_speakers.repeat(1, embedded_text.size(1), 1)
+        embedded_speakers = embedded_speakers.repeat(1, T, 1)
         if hasattr(self, "gst"):
-            embedded_gst = embedded_gst.repeat(1, embedded_text.size(1), 1)
+            # NOTE: a style token index gives one embedding for the batch.
+            embedded_gst = embedded_gst.expand(B, T, -1)
             encoder_outputs = torch.cat(
                 (embedded_text, embedded_gst, embedded_speakers), dim=2
             )
         else:
             encoder_outputs = torch.cat((embedded_text, embedded_speakers), dim=2)
+        return encoder_outputs
+
+    def inference(self, inputs):
+        """Synthesize a single utterance. See inference_batch."""
+        return self.inference_batch(inputs)[:4]
+
+    def inference_batch(self, inputs, input_lengths=None):
+        """Synthesize a batch of utterances in one decoding loop.
+
+        inputs are text (B, T_in), the style (a style token index or reference
+        mels), speaker_ids (B,) and, if include_f0, f0s. Pass input_lengths if
+        the texts are padded: attention then ignores the padding.
+
+        Returns mel_outputs, mel_outputs_postnet, gate_outputs, alignments and
+        mel_lengths, the number of frames synthesized for each utterance.
+        Frames past an utterance's length are zeroed.
+        """
+        text, style_input, speaker_ids, *_ = inputs
+        if self.include_f0:
+            f0s = inputs[3]
+        else:
+            f0s = None
+        encoder_outputs = self._inference_memory(
+            text, style_input, speaker_ids, input_lengths
+        )
 
-        mel_outputs, gate_outputs, alignments = self.decoder.inference(
-            encoder_outputs, f0s
+        mel_outputs, gate_outputs, alignments, mel_lengths = self.decoder.inference(
+            encoder_outputs, f0s, memory_lengths=input_lengths
         )
 
-        mel_outputs_postnet = self.postnet(mel_outputs)
+        mel_outputs_postnet = self.postnet(mel_outputs, mel_lengths)
         mel_outputs_postnet = mel_outputs + mel_outputs_postnet
 
-        return self.parse_output(
-            [mel_outputs, mel_outputs_postnet, gate_outputs, alignments]
+        outputs = self.parse_output(
+            [mel_outputs, mel_outputs_postnet, gate_outputs, alignments], mel_lengths
+        )
+        return outputs + [mel_lengths]
+
+    def inference_stream(self, inputs, input_lengths=None, chunk_steps=32):
+        """Synthesize like inference_batch, yielding mel_outputs_postnet in
+        chunks of time as decoding goes on, so that a vocoder can start on the
+        first chunk long before the last one is decoded.
+
+        A chunk is yielded every chunk_steps decoder steps. The postnet output
+        for a frame depends on postnet.context frames on either side of it, so
+        each chunk stops that many frames short of the last decoded frame,
+        and the rest is yielded once decoding is done. Concatenated along
+        time, the chunks are the mel_outputs_postnet of inference_batch.
+        """
+        text, style_input, speaker_ids, *_ = inputs
+        if self.include_f0:
+            f0s = inputs[3]
+        else:
+            f0s = None
+        encoder_outputs = self._inference_memory(
+            text, style_input, speaker_ids, input_lengths
         )
 
+        n_frames_per_step = self.n_frames_per_step_current
+        emitted = 0
+        last_chunk_step = 0
+        for step, mel_outputs, _, _, mel_lengths, _ in self.decoder.inference_steps(
+            encoder_outputs, f0s, memory_lengths=input_lengths
+        ):
+            if step - last_chunk_step < chunk_steps:
+                continue
+            last_chunk_step = step
+            n_frames = step * n_frames_per_step
+            # Steps decoded after every row had finished aren't part of the
+            # output, as in Decoder.inference.
+            end = min(n_frames - self.postnet.context, int(mel_lengths.max()))
+            if end > emitted:
+                yield self._postnet_chunk(
+                    mel_outputs, emitted, end, n_frames, mel_lengths
+                )
+                emitted = end
+
+        end = int(mel_lengths.max())
+        if end > emitted:
+            yield self._postnet_chunk(
+                mel_outputs, emitted, end, step * n_frames_per_step, mel_lengths
+            )
+
+    def _postnet_chunk(self, mel_outputs, start, end, n_frames, mel_lengths):
+        """mel_outputs_postnet for frames start:end of the n_frames decoded so
+        far into mel_outputs, a (B, n_steps, frame_size) decoder buffer. The
+        postnet is run on just the frames the chunk depends on."""
+        B = mel_outputs.size(0)
+        lo = max(0, start - self.postnet.context)
+        hi = min(n_frames, end + self.postnet.context)
+        first_step = lo // self.n_frames_per_step_current
+        last_step = -(-hi // self.n_frames_per_step_current)
+        offset = first_step * self.n_frames_per_step_current
+        mel = mel_outputs[:, first_step:last_step].reshape(B, -1, self.n_mel_channels)
+        mel = mel.transpose(1, 2)[:, :, lo - offset : hi - offset]
+
+        # Rows that haven't finished have n_frames frames so far, so they
+        # run to the end of the window.
+        lengths = (mel_lengths - lo).clamp(0, hi - lo)
+        mel = mel.masked_fill(
+            ~get_mask_from_lengths(lengths, hi - lo).unsqueeze(1), 0.0
+        )
+        mel_postnet = mel + self.postnet(mel, lengths)
+        chunk = mel_postnet[:, :, start - lo : end - lo]
+        if self.mask_padding:
+            mask = get_mask_from_lengths(lengths - (start - lo), end - start)
+            chunk = chunk.masked_fill(~mask.unsqueeze(1), 0.0)
+        return chunk
+
     def inference_noattention(self, inputs):
         """Run inference conditioned on an attention map.
 
@@ -844,28 +1060,7 @@ class Tacotron2(TTSModel):
         would always want to condition on pitch when conditioning on rhythm.
         """
         text, style_input, speaker_ids, f0s, attention_map = inputs
-        embedded_inputs = self.embedding(text).transpose(1, 2)
-        embedded_text = self.encoder.inference(embedded_inputs)
-        embedded_speakers = self.speaker_embedding(speaker_ids)[:, None]
-        if hasattr(self, "gst"):
-            if isinstance(style_input, int):
-                query = torch.zeros(1, 1, self.gst.encoder.ref_enc_gru_size)
-                if torch.cuda.is_available():
-                    query = query.cuda()
-                GST = torch.tanh(self.gst.stl.embed)
-                key = GST[style_input].unsqueeze(0).expand(1, -1, -1)
-                embedded_gst = self.gst.stl.attention(query, key)
-            else:
-                embedded_gst = self.gst(style_input)
-
-        embedded_speakers = embedded_speakers.repeat(1, embedded_text.size(1), 1)
-        if hasattr(self, "gst"):
-            embedded_gst = embedded_gst.repeat(1, embedded_text.size(1), 1)
-            encoder_outputs = torch.cat(
-                (embedded_text, embedded_gst, embedded_speakers), dim=2
-            )
-        else:
-            encoder_outputs = torch.cat((embedded_text, embedded_speakers), dim=2)
+        encoder_outputs = self._inference_memory(text, style_input, speaker_ids)
 
         mel_outputs, gate_outputs, alignments = self.decoder.inference_noattention(
             encoder_outputs, f0s, attention_map
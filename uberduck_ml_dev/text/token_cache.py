@@ -0,0 +1,141 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/text.token_cache.ipynb (unless otherwise specified).
+
+__all__ = ['token_cache_key', 'TokenCache', 'TOKEN_CACHE_VERSION']
+
+# Cell
+import hashlib
+import json
+import os
+import random
+import shutil
+import uuid
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+from .symbols import (
+    DEFAULT_SYMBOLS,
+    arpabet_to_sequence,
+    symbol_to_id,
+    symbols_to_sequence,
+)
+from .util import convert_to_arpabet, text_to_words
+
+TOKEN_CACHE_VERSION = 1
+
+
+def token_cache_key(cleaner_names: List[str], include_arpabet: bool):
+    # NOTE: text_to_sequence always tokenizes with the default symbol set.
+    config = dict(
+        cleaner_names=list(cleaner_names),
+        include_arpabet=include_arpabet,
+        symbols=sorted(symbol_to_id[DEFAULT_SYMBOLS].items()),
+        version=TOKEN_CACHE_VERSION,
+    )
+    serialized = json.dumps(config, sort_keys=True)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()[:16]
+
+
+class TokenCache:
+    """Tokenized transcripts for one set of cleaners.
+
+    pieces has a row (start, length, arpabet_start, arpabet_length) for each
+    piece of each transcript, indexing into tokens. arpabet_length is -1 for
+    pieces without an ARPAbet alternative.
+    """
+
+    def __init__(self, root, cleaner_names: List[str], include_arpabet: bool = False):
+        self.root = Path(root)
+        self.cleaner_names = cleaner_names
+        self.include_arpabet = include_arpabet
+        self.path = self.root / token_cache_key(cleaner_names, include_arpabet)
+        if not self.path.exists():
+            raise FileNotFoundError(f"No token cache found at {self.path}")
+        self.tokens = np.load(self.path / "tokens.npy", mmap_mode="r")
+        self.pieces = np.load(self.path / "pieces.npy", mmap_mode="r")
+        self.offsets = np.load(self.path / "offsets.npy", mmap_mode="r")
+        with open(self.path / "transcripts.json", encoding="utf-8") as f:
+            self._rows = {t: i for i, t in enumerate(json.load(f))}
+
+    @staticmethod
+    def exists(root, cleaner_names: List[str], include_arpabet: bool = False):
+        key = token_cache_key(cleaner_names, include_arpabet)
+        return (Path(root) / key / "transcripts.json").exists()
+
+    @classmethod
+    def build(
+        cls,
+        root,
+        transcripts: List[str],
+        cleaner_names: List[str],
+        include_arpabet: bool = False,
+    ):
+        """Tokenize transcripts and write them to a new cache under root."""
+        root = Path(root)
+        key = token_cache_key(cleaner_names, include_arpabet)
+        transcripts = list(dict.fromkeys(transcripts))
+        tokens, pieces, offsets = [], [], [0]
+        n_tokens = 0
+        arpabet_words = {}
+
+        def add(sequence):
+            nonlocal n_tokens
+            tokens.append(np.asarray(sequence, dtype=np.int16))
+            n_tokens += len(sequence)
+            return n_tokens - len(sequence), len(sequence)
+
+        for transcript in transcripts:
+            for word, sequence in text_to_words(transcript, cleaner_names):
+                if word is None:
+                    pieces.append(add(sequence) + (0, -1))
+                    continue
+                piece = add(symbols_to_sequence(word))
+                if include_arpabet:
+                    if word not in arpabet_words:
+                        arpabet = arpabet_to_sequence(convert_to_arpabet(word))
+                        arpabet_words[word] = add(arpabet)
+                    piece += arpabet_words[word]
+                else:
+                    piece += (0, -1)
+                pieces.append(piece)
+            offsets.append(len(pieces))
+
+        tmp_path = root / f".{key}.tmp-{uuid.uuid4().hex[:8]}"
+        os.makedirs(tmp_path)
+        tokens = np.concatenate(tokens) if tokens else np.zeros(0, dtype=np.int16)
+        np.save(tmp_path / "tokens.npy", tokens)
+        np.save(
+            tmp_path / "pieces.npy", np.array(pieces, dtype=np.int32).reshape(-1, 4)
+        )
+        np.save(tmp_path / "offsets.npy", np.array(offsets, dtype=np.int64))
+        with open(tmp_path / "transcripts.json", "w", encoding="utf-8") as f:
+            json.dump(transcripts, f)
+        if (root / key).exists():
+            # Another process finished building the same cache first.
+            shutil.rmtree(tmp_path)
+        else:
+            os.replace(tmp_path, root / key)
+        return cls(root, cleaner_names, include_arpabet)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, transcript):
+        return transcript in self._rows
+
+    def get(self, transcript, p_arpabet=0.0):
+        """Same as text_to_sequence(transcript, cleaner_names, p_arpabet)."""
+        row = self._rows[transcript]
+        pieces = self.pieces[self.offsets[row] : self.offsets[row + 1]]
+        starts = np.array(pieces[:, 0])
+        lengths = np.array(pieces[:, 1])
+        if p_arpabet > 0:
+            assert self.include_arpabet, "Cache was built without ARPAbet."
+            for i in np.flatnonzero(pieces[:, 3] >= 0):
+                if random.random() < p_arpabet:
+                    starts[i], lengths[i] = pieces[i, 2], pieces[i, 3]
+        # Gather tokens[starts[i] : starts[i] + lengths[i]] for every piece.
+        out_starts = np.cumsum(lengths) - lengths
+        idx = np.repeat(starts - out_starts, lengths) + np.arange(lengths.sum())
+        return self.tokens[idx].tolist()
\ No newline at end of file
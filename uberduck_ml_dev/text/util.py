@@ -1,10 +1,11 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/text.util.ipynb (unless otherwise specified).
 
-__all__ = ['normalize_numbers', 'expand_abbreviations', 'expand_numbers', 'lowercase', 'collapse_whitespace',
-           'convert_to_ascii', 'convert_to_arpabet', 'basic_cleaners', 'transliteration_cleaners', 'english_cleaners',
-           'english_cleaners_phonemizer', 'batch_english_cleaners_phonemizer', 'g2p', 'batch_clean_text', 'clean_text',
-           'english_to_arpabet', 'cleaned_text_to_sequence', 'text_to_sequence', 'sequence_to_text', 'BATCH_CLEANERS',
-           'CLEANERS', 'random_utterance', 'utterances']
+__all__ = ['G2PCache', 'set_g2p_cache', 'normalize_numbers', 'expand_abbreviations', 'expand_numbers', 'lowercase',
+           'collapse_whitespace', 'convert_to_ascii', 'convert_to_arpabet', 'basic_cleaners',
+           'transliteration_cleaners', 'english_cleaners', 'english_cleaners_phonemizer',
+           'batch_english_cleaners_phonemizer', 'g2p', 'G2P_CACHE_LOCATION', 'g2p_cache', 'batch_clean_text',
+           'clean_text', 'english_to_arpabet', 'cleaned_text_to_sequence', 'text_to_words', 'text_to_sequence',
+           'sequence_to_text', 'BATCH_CLEANERS', 'CLEANERS', 'random_utterance', 'utterances']
 
 # Cell
 """ from https://github.com/keithito/tacotron """
@@ -21,7 +22,11 @@ hyperparameter. Some cleaners are English-specific. You'll typically want to use
 """
 
 
+from importlib.metadata import PackageNotFoundError, version
+import os
+from pathlib import Path
 import re
+import sqlite3
 from typing import List
 
 from g2p_en import G2p
@@ -30,7 +35,124 @@ from unidecode import unidecode
 
 from .symbols import curly_re, words_re
 
-g2p = G2p()
+
+class _LazyG2p:
+    """Load the G2p model on first use instead of at import, so dataloader
+    workers that only hit the G2P cache never load it."""
+
+    def __init__(self):
+        self._model = None
+
+    def _load(self):
+        if self._model is None:
+            self._model = G2p()
+        return self._model
+
+    def __call__(self, text):
+        return self._load()(text)
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+
+g2p = _LazyG2p()
+
+try:
+    G2P_MODEL = f"g2p_en-{version('g2p_en')}"
+except PackageNotFoundError:
+    G2P_MODEL = "g2p_en"
+
+# Set UBERDUCK_G2P_CACHE to move the cache, or to an empty string to turn it off.
+G2P_CACHE_LOCATION = os.environ.get(
+    "UBERDUCK_G2P_CACHE", str(Path.home() / Path(".cache/uberduck/g2p.db"))
+)
+
+
+class G2PCache:
+    """Disk-backed cache of convert_to_arpabet results, consulted before the
+    neural G2P model and filled lazily.
+
+    Backed by SQLite in WAL mode, so many dataloader workers can read it while
+    others write. Each process opens its own connection. hits and misses count
+    lookups in the current process. Entries are keyed by model as well as by
+    word, so upgrading g2p_en doesn't serve the old model's pronunciations.
+    """
+
+    def __init__(self, path=G2P_CACHE_LOCATION, model=G2P_MODEL):
+        self.path = Path(path)
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+        self._memo = {}
+        self._conn = None
+        self._pid = None
+        self._disabled = False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        return state
+
+    def _connect(self):
+        if self._disabled:
+            return None
+        if self._conn is None or self._pid != os.getpid():
+            try:
+                os.makedirs(self.path.parent, exist_ok=True)
+                conn = sqlite3.connect(str(self.path), timeout=30)
+                conn.execute("PRAGMA journal_mode=WAL")
+                with conn:
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS pronunciations "
+                        "(model TEXT, word TEXT, arpabet TEXT, PRIMARY KEY (model, word))"
+                    )
+            except (OSError, sqlite3.Error) as e:
+                print(f"Could not open G2P cache at {self.path}, disabling it: {e}")
+                self._disabled = True
+                return None
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, word):
+        if word in self._memo:
+            self.hits += 1
+            return self._memo[word]
+        conn = self._connect()
+        row = None
+        if conn is not None:
+            row = conn.execute(
+                "SELECT arpabet FROM pronunciations WHERE model = ? AND word = ?",
+                (self.model, word),
+            ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._memo[word] = row[0]
+        return row[0]
+
+    def put(self, word, arpabet):
+        self._memo[word] = arpabet
+        conn = self._connect()
+        if conn is None:
+            return
+        with conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO pronunciations VALUES (?, ?, ?)",
+                (self.model, word, arpabet),
+            )
+
+
+# None always runs the G2P model.
+g2p_cache = G2PCache() if G2P_CACHE_LOCATION else None
+
+
+def set_g2p_cache(path):
+    """Use the G2P cache at path, or no cache if path is None."""
+    global g2p_cache
+    g2p_cache = None if path is None else G2PCache(path)
+
 
 # Regular expression matching whitespace:
 _whitespace_re = re.compile(r"\s+")
@@ -156,12 +278,19 @@ def convert_to_ascii(text):
 
 
 def convert_to_arpabet(text):
-    return " ".join(
+    if g2p_cache is not None:
+        arpabet = g2p_cache.get(text)
+        if arpabet is not None:
+            return arpabet
+    arpabet = " ".join(
         [
             f"{{ {s.strip()} }}" if s.strip() not in ",." else s.strip()
             for s in " ".join(g2p(text)).split("  ")
         ]
     )
+    if g2p_cache is not None:
+        g2p_cache.put(text, arpabet)
+    return arpabet
 
 
 def basic_cleaners(text):
@@ -272,6 +401,31 @@ def cleaned_text_to_sequence(cleaned_text, symbol_set):
     return symbols_to_sequence(cleaned_text, symbol_set=symbol_set, ignore_symbols=[])
 
 
+def text_to_words(text, cleaner_names):
+    """Split text into words and fixed symbol sequences.
+
+    Yields (word, None) for cleaned words, which text_to_sequence may convert to
+    ARPAbet, and (None, sequence) for everything else: whitespace, punctuation
+    and ARPAbet enclosed in curly braces.
+    """
+    while len(text):
+        m = curly_re.match(text)
+        if not m:
+            cleaned = clean_text(text, cleaner_names)
+            for w, nw in words_re.findall(cleaned):
+                if w:
+                    yield w, None
+                elif nw.startswith("{"):
+                    yield None, arpabet_to_sequence(nw)
+                else:
+                    yield None, symbols_to_sequence(nw)
+            break
+        cleaned = clean_text(m.group(1), cleaner_names)
+        yield from text_to_words(cleaned, cleaner_names)
+        yield None, arpabet_to_sequence(m.group(2))
+        text = m.group(3)
+
+
 def text_to_sequence(text, cleaner_names, p_arpabet=0.0, symbol_set=DEFAULT_SYMBOLS):
     """Converts a string of text to a sequence of IDs corresponding to the symbols in the text.
     The text can optionally have ARPAbet sequences enclosed in curly braces embedded
@@ -283,32 +437,13 @@ def text_to_sequence(text, cleaner_names, p_arpabet=0.0, symbol_set=DEFAULT_SYMB
       List of integers corresponding to the symbols in the text
     """
     sequence = []
-
-    # Check for curly braces and treat their contents as ARPAbet:
-    while len(text):
-        m = curly_re.match(text)
-        if not m:
-            cleaned = clean_text(text, cleaner_names)
-            words_and_nonwords = words_re.findall(cleaned)
-            cleaned_words = []
-            for w, nw in words_and_nonwords:
-                if w and random.random() < p_arpabet:
-                    cleaned_words.append(convert_to_arpabet(w))
-                elif w:
-                    cleaned_words.append(w)
-                else:
-                    cleaned_words.append(nw)
-            for word in cleaned_words:
-                if word.startswith("{"):
-                    sequence += arpabet_to_sequence(word)
-                else:
-                    sequence += symbols_to_sequence(word)
-            break
-        cleaned = clean_text(m.group(1), cleaner_names)
-        sequence += text_to_sequence(cleaned, cleaner_names, p_arpabet)
-        sequence += arpabet_to_sequence(m.group(2))
-        text = m.group(3)
-
+    for word, word_sequence in text_to_words(text, cleaner_names):
+        if word is None:
+            sequence += word_sequence
+        elif random.random() < p_arpabet:
+            sequence += arpabet_to_sequence(convert_to_arpabet(word))
+        else:
+            sequence += symbols_to_sequence(word)
     return sequence
 
 
@@ -14,7 +14,7 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.tensorboard import SummaryWriter
 import time
 
-from ..models.common import MelSTFT
+from ..models.common import get_mel_stft
 from ..utils.plot import (
     plot_attention,
     plot_gate_outputs,
@@ -103,8 +103,8 @@ class TTSTrainer:
         if self.rank is not None and self.rank != 0:
             return
         if algorithm == "griffin-lim":
-            mel_stft = MelSTFT()
-            audio = mel_stft.griffin_lim(mel)
+            mel_stft = get_mel_stft()
+            audio = mel_stft.griffin_lim(mel, **kwargs)
         else:
             raise NotImplemented
         return audio
@@ -122,7 +122,13 @@ from torch import nn
 from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
 
-from ..data_loader import TextMelDataset, TextMelCollate
+from ..data.shards import ShardedDataset
+from ..data_loader import (
+    FrameBudgetBatchSampler,
+    TextMelDataset,
+    TextMelCollate,
+    WeightedDistributedSampler,
+)
 from ..models.mellotron import Tacotron2
 from ..utils.plot import save_figure_to_numpy
 from ..utils.utils import reduce_tensor, get_alignment_metrics
@@ -388,6 +394,8 @@ class MellotronTrainer(TTSTrainer):
         bs = settings["batch_size"]
         print(f"Adjusting frames per step from {old_fps} to {fps}")
         self.batch_size = bs
+        if "batch_max_frames" in settings:
+            self.batch_max_frames = settings["batch_max_frames"]
         model.set_current_frames_per_step(fps)
         self.n_frames_per_step_current = fps
         _, _, train_loader, sampler, collate_fn = self.initialize_loader()
@@ -539,13 +547,27 @@ class MellotronTrainer(TTSTrainer):
         return val_args
 
     def initialize_loader(self):
+        feature_store = getattr(self, "feature_store_path", None)
+        token_cache = getattr(self, "token_cache_path", None)
+        manifest = getattr(self, "manifest_path", None)
         train_set = TextMelDataset(
             *self.training_dataset_args,
             debug=self.debug,
             debug_dataset_size=self.batch_size,
+            feature_store=feature_store,
+            token_cache=token_cache,
+            manifest=manifest,
+            stft_backend=getattr(self, "stft_backend", "conv"),
+            oversample_weights=getattr(self, "oversample_weights", None),
         )
         val_set = TextMelDataset(
-            *self.val_dataset_args, debug=self.debug, debug_dataset_size=self.batch_size
+            *self.val_dataset_args,
+            debug=self.debug,
+            debug_dataset_size=self.batch_size,
+            feature_store=feature_store,
+            token_cache=token_cache,
+            manifest=manifest,
+            stft_backend=getattr(self, "stft_backend", "conv"),
         )
         collate_fn = TextMelCollate(
             n_frames_per_step=self.n_frames_per_step_current, include_f0=self.include_f0
@@ -553,6 +575,43 @@ class MellotronTrainer(TTSTrainer):
         sampler = None
         if self.distributed_run:
             self.init_distributed()
+        sharded_dataset_path = getattr(self, "sharded_dataset_path", None)
+        if sharded_dataset_path:
+            # NOTE: the sharded dataset shuffles and splits across ranks
+            # itself, and needs set_epoch like a sampler.
+            sampler = ShardedDataset(
+                sharded_dataset_path,
+                decode=train_set.decode_sample,
+                seed=self.seed,
+                rank=self.rank if self.distributed_run else None,
+            )
+            train_loader = DataLoader(
+                sampler, batch_size=self.batch_size, collate_fn=collate_fn
+            )
+            return train_set, val_set, train_loader, sampler, collate_fn
+        batch_max_frames = getattr(self, "batch_max_frames", None)
+        if batch_max_frames:
+            sampler = FrameBudgetBatchSampler(
+                train_set,
+                batch_max_frames,
+                n_frames_per_step=self.n_frames_per_step_current,
+                rank=self.rank if self.distributed_run else None,
+                seed=self.seed,
+            )
+            train_loader = DataLoader(
+                train_set, batch_sampler=sampler, collate_fn=collate_fn
+            )
+            return train_set, val_set, train_loader, sampler, collate_fn
+        if (train_set.sample_weights != 1).any():
+            # NOTE: oversampled speakers are drawn more often rather than
+            # duplicated in the dataset.
+            sampler = WeightedDistributedSampler(
+                train_set,
+                num_replicas=None if self.distributed_run else 1,
+                rank=self.rank if self.distributed_run else 0,
+                seed=self.seed,
+            )
+        elif self.distributed_run:
             sampler = DistributedSampler(train_set, rank=self.rank)
         train_loader = DataLoader(
             train_set,
@@ -619,7 +678,7 @@ class MellotronTrainer(TTSTrainer):
             train_loader, sampler, collate_fn = self.adjust_frames_per_step(
                 model, train_loader, sampler, collate_fn
             )
-            if self.distributed_run:
+            if sampler is not None:
                 sampler.set_epoch(epoch)
             for batch in train_loader:
                 start_time = time.perf_counter()
@@ -18,7 +18,7 @@ from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 import time
 
-from ..models.common import MelSTFT
+from ..models.common import get_mel_stft
 from ..utils.plot import (
     plot_attention,
     plot_gate_outputs,
@@ -33,6 +33,7 @@ from ..models.vits import (
     MultiPeriodDiscriminator,
     SynthesizerTrn,
 )
+from ..data.shards import ShardedDataset
 from ..data_loader import (
     TextAudioSpeakerLoader,
     TextAudioSpeakerCollate,
@@ -40,7 +41,11 @@ from ..data_loader import (
 )
 from ..vendor.tfcompat.hparam import HParams
 from ..utils.plot import save_figure_to_numpy, plot_spectrogram
-from ..utils.utils import slice_segments, clip_grad_value_
+from ..utils.utils import (
+    slice_segments,
+    slice_ragged_segments,
+    clip_grad_value_,
+)
 
 # Cell
 
@@ -124,10 +129,11 @@ class VITSTrainer(TTSTrainer):
         for param in self.REQUIRED_HPARAMS:
             if not hasattr(self, param):
                 raise Exception(f"VITSTrainer missing a required param: {param}")
-        self.mel_stft = MelSTFT(
+        self.mel_stft = get_mel_stft(
             device=self.device,
             rank=self.rank,
             padding=(self.filter_length - self.hop_length) // 2,
+            stft_backend=getattr(self, "stft_backend", "conv"),
         )
 
     def init_distributed(self):
@@ -263,7 +269,11 @@ class VITSTrainer(TTSTrainer):
         optim_g, optim_d = optims
         scheduler_g, scheduler_d = schedulers
         train_loader, val_loader = loaders
-        train_loader.batch_sampler.set_epoch(epoch)
+        sharded = isinstance(train_loader.dataset, ShardedDataset)
+        if sharded:
+            train_loader.dataset.set_epoch(epoch)
+        else:
+            train_loader.batch_sampler.set_epoch(epoch)
         net_g.train()
         net_d.train()
         # TODO (zach): remove when you want to.
@@ -298,7 +308,9 @@ class VITSTrainer(TTSTrainer):
                     mel, ids_slice, self.segment_size // self.hop_length
                 )
                 y_hat_mel = self.mel_stft.mel_spectrogram(y_hat.squeeze(1))
-                y = slice_segments(y, ids_slice * self.hop_length, self.segment_size)
+                y = slice_ragged_segments(
+                    y, y_lengths, ids_slice * self.hop_length, self.segment_size
+                )
 
                 # Discriminator
                 y_d_hat_r, y_d_hat_g, _, _ = net_d(y, y_hat.detach())
@@ -359,35 +371,61 @@ class VITSTrainer(TTSTrainer):
                     ),
                 )
             self.global_step += 1
+        if not sharded:
+            self.log(
+                "Train/padding_ratio",
+                self.global_step,
+                scalar=train_loader.batch_sampler.padding_ratio,
+            )
         if self.rank == 0:
             self._evaluate(net_g, val_loader)
 
     def train(self):
         if self.distributed_run:
             self.init_distributed()
-        train_dataset = TextAudioSpeakerLoader(
-            self.training_audiopaths_and_text,
-            self.hparams,
-            debug=self.debug,
-            debug_dataset_size=self.debug_dataset_size,
-        )
-        train_sampler = DistributedBucketSampler(
-            train_dataset,
-            self.batch_size,
-            [32, 300, 400, 500, 600, 700, 800, 900, 1000],
-            num_replicas=self.world_size,
-            rank=self.rank,
-            shuffle=True,
-        )
-        collate_fn = TextAudioSpeakerCollate()
-        train_loader = DataLoader(
-            train_dataset,
-            num_workers=0,
-            shuffle=False,
-            pin_memory=True,
-            collate_fn=collate_fn,
-            batch_sampler=train_sampler,
-        )
+        # NOTE: training only uses a segment_size slice of each clip, so
+        # don't pad the training waveforms.
+        sharded_dataset_path = getattr(self, "sharded_dataset_path", None)
+        if sharded_dataset_path:
+            # The shard index has the sample counts, so the filelist and its
+            # wavs aren't read.
+            decoder = TextAudioSpeakerLoader(None, self.hparams)
+            train_loader = DataLoader(
+                ShardedDataset(
+                    sharded_dataset_path,
+                    decode=decoder.decode_sample,
+                    seed=self.seed,
+                    num_replicas=self.world_size,
+                    rank=self.rank,
+                ),
+                num_workers=0,
+                batch_size=self.batch_size,
+                pin_memory=True,
+                collate_fn=TextAudioSpeakerCollate(ragged_wav=True),
+            )
+        else:
+            train_dataset = TextAudioSpeakerLoader(
+                self.training_audiopaths_and_text,
+                self.hparams,
+                debug=self.debug,
+                debug_dataset_size=self.debug_dataset_size,
+            )
+            train_sampler = DistributedBucketSampler(
+                train_dataset,
+                self.batch_size,
+                getattr(self, "bucket_boundaries", None),
+                num_replicas=self.world_size,
+                rank=self.rank,
+                shuffle=True,
+            )
+            train_loader = DataLoader(
+                train_dataset,
+                num_workers=0,
+                shuffle=False,
+                pin_memory=True,
+                collate_fn=TextAudioSpeakerCollate(ragged_wav=True),
+                batch_sampler=train_sampler,
+            )
         val_dataset, val_loader = None, None
         if self.rank == 0:
             val_dataset = TextAudioSpeakerLoader(
@@ -403,7 +441,7 @@ class VITSTrainer(TTSTrainer):
                 batch_size=self.batch_size,
                 pin_memory=True,
                 drop_last=False,
-                collate_fn=collate_fn,
+                collate_fn=TextAudioSpeakerCollate(),
             )
 
         model_kwargs = {k: v for k, v in DEFAULTS.values().items() if hasattr(self, k)}
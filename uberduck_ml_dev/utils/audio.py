@@ -1,8 +1,9 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/utils.audio.ipynb (unless otherwise specified).
 
 __all__ = ['mel_to_audio', 'differenceFunction', 'cumulativeMeanNormalizedDifferenceFunction', 'getPitch',
-           'compute_yin', 'convert_to_wav', 'match_target_amplitude', 'modify_leading_silence',
-           'normalize_audio_segment', 'normalize_audio', 'trim_audio', 'MAX_WAV_INT16', 'load_wav_to_torch']
+           'batch_compute_yin', 'compute_yin', 'convert_to_wav', 'match_target_amplitude', 'modify_leading_silence',
+           'normalize_audio_segment', 'normalize_audio', 'trim_audio', 'MAX_WAV_INT16', 'read_wav', 'load_wav_to_torch',
+           'iter_wav_blocks']
 
 # Cell
 """
@@ -38,12 +39,12 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 # Cell
-from ..models.common import MelSTFT
+from ..models.common import get_mel_stft
 
 def mel_to_audio(mel, algorithm="griffin-lim", **kwargs):
         if algorithm == "griffin-lim":
-            mel_stft = MelSTFT()
-            audio = mel_stft.griffin_lim(mel)
+            mel_stft = get_mel_stft()
+            audio = mel_stft.griffin_lim(mel, **kwargs)
         else:
             raise NotImplemented
         return audio
@@ -54,6 +55,7 @@ def mel_to_audio(mel, algorithm="griffin-lim", **kwargs):
 import numpy as np
 from scipy.io.wavfile import read
 import torch
+from torch.nn import functional as F
 
 
 def differenceFunction(x, N, tau_max):
@@ -120,6 +122,70 @@ def getPitch(cmdf, tau_min, tau_max, harmo_th=0.1):
     return 0  # if unvoiced
 
 
+def batch_compute_yin(
+    signals, sr, w_len=512, w_step=256, f0_min=100, f0_max=500, harmo_thresh=0.1
+):
+    """Compute the Yin Algorithm for a batch of signals at once.
+
+    Frames every signal with a strided view, runs one rFFT over all frames and
+    picks pitches with array ops instead of looping over frames. Works on any
+    device; use float64 signals to match compute_yin closely.
+
+    :param signals: (batch, samples) tensor
+    :returns: pitches, harmonic_rates, argmins as (batch, n_frames) tensors,
+        with the same meaning as in compute_yin.
+    """
+    tau_min = int(sr / f0_max)
+    tau_max = int(sr / f0_min)
+    n_frames = len(range(0, signals.size(-1) - w_len, w_step))
+    if n_frames == 0:
+        empty = signals.new_zeros(signals.size(0), 0)
+        return empty, empty, empty
+    # (batch, n_frames, w_len) view, no copy.
+    x = signals.unfold(-1, w_len, w_step)[:, :n_frames]
+
+    # Difference function, equation (6) in [1].
+    w = w_len
+    tau_max = min(tau_max, w)
+    x_cumsum = F.pad(torch.cumsum(x * x, -1), (1, 0))
+    size = w + tau_max
+    p2 = (size // 32).bit_length()
+    nice_numbers = (16, 18, 20, 24, 25, 27, 30, 32)
+    size_pad = min(n * 2 ** p2 for n in nice_numbers if n * 2 ** p2 >= size)
+    fc = torch.fft.rfft(x, size_pad)
+    conv = torch.fft.irfft(fc * fc.conj(), size_pad)[..., :tau_max]
+    df = (
+        x_cumsum[..., w - tau_max + 1 : w + 1].flip(-1)
+        + x_cumsum[..., w : w + 1]
+        - x_cumsum[..., :tau_max]
+        - 2 * conv
+    )
+
+    # Cumulative mean normalized difference function, equation (8) in [1].
+    taus = torch.arange(1, tau_max, device=x.device, dtype=x.dtype)
+    cmdf = df[..., 1:] * taus / torch.cumsum(df[..., 1:], -1)
+    cmdf = F.pad(cmdf, (1, 0), value=1.0)
+
+    # Pitch: the first tau under the threshold, then down to the local minimum.
+    below = cmdf[..., tau_min:tau_max] < harmo_thresh
+    voiced = below.any(-1)
+    first = below.int().argmax(-1) + tau_min
+    stop = torch.ones_like(cmdf, dtype=torch.bool)
+    stop[..., :-1] = ~(cmdf[..., 1:] < cmdf[..., :-1])
+    stop &= torch.arange(tau_max, device=x.device) >= first[..., None]
+    tau = stop.int().argmax(-1)
+
+    zero = cmdf.new_zeros(())
+    pitches = torch.where(voiced, sr / tau.to(cmdf.dtype), zero)
+    min_cmdf = torch.where(torch.isnan(cmdf), cmdf.new_tensor(float("inf")), cmdf)
+    harmonic_rates = torch.where(
+        voiced, cmdf.gather(-1, tau[..., None])[..., 0], min_cmdf.min(-1).values
+    )
+    argmin = cmdf.argmin(-1)
+    argmins = torch.where(argmin > tau_min, sr / argmin.to(cmdf.dtype), zero)
+    return pitches, harmonic_rates, argmins
+
+
 def compute_yin(
     sig, sr, w_len=512, w_step=256, f0_min=100, f0_max=500, harmo_thresh=0.1
 ):
@@ -144,35 +210,15 @@ def compute_yin(
     :rtype: tuple
     """
 
-    tau_min = int(sr / f0_max)
-    tau_max = int(sr / f0_min)
-
     timeScale = range(
         0, len(sig) - w_len, w_step
     )  # time values for each analysis window
     times = [t / float(sr) for t in timeScale]
-    frames = [sig[t : t + w_len] for t in timeScale]
-
-    pitches = [0.0] * len(timeScale)
-    harmonic_rates = [0.0] * len(timeScale)
-    argmins = [0.0] * len(timeScale)
-
-    for i, frame in enumerate(frames):
-        # Compute YIN
-        df = differenceFunction(frame, w_len, tau_max)
-        cmdf = cumulativeMeanNormalizedDifferenceFunction(df, tau_max)
-        p = getPitch(cmdf, tau_min, tau_max, harmo_thresh)
-
-        # Get results
-        if np.argmin(cmdf) > tau_min:
-            argmins[i] = float(sr / np.argmin(cmdf))
-        if p != 0:  # A pitch was found
-            pitches[i] = float(sr / p)
-            harmonic_rates[i] = cmdf[p]
-        else:  # No pitch, but we compute a value of the harmonic rate
-            harmonic_rates[i] = min(cmdf)
-
-    return pitches, harmonic_rates, argmins, times
+    signal = torch.from_numpy(np.asarray(sig, dtype=np.float64))
+    pitches, harmonic_rates, argmins = batch_compute_yin(
+        signal[None], sr, w_len, w_step, f0_min, f0_max, harmo_thresh
+    )
+    return pitches[0].tolist(), harmonic_rates[0].tolist(), argmins[0].tolist(), times
 
 # Cell
 import os
@@ -265,6 +311,48 @@ def trim_audio(path, new_path, top_db=20):
 # Cell
 
 
-def load_wav_to_torch(path):
-    sr, data = read(path)
-    return torch.FloatTensor(data.astype(np.float32)), sr
\ No newline at end of file
+def read_wav(path, start=0, stop=None):
+    """Read samples start:stop of a wav without loading the rest of the file.
+
+    The PCM payload is memory-mapped, so the returned array is a view that
+    only pages in the requested range.
+    """
+    try:
+        sr, data = read(path, mmap=True)
+    except ValueError:
+        # NOTE: scipy can't mmap every format (e.g. 24-bit PCM).
+        sr, data = read(path)
+    return sr, data[start:stop]
+
+
+def load_wav_to_torch(path, max_wav_value=None, start=0, stop=None, out=None):
+    """Load samples start:stop of a wav as a float32 tensor.
+
+    The samples are converted, and divided by max_wav_value if given, in a
+    single pass. Pass a float32 tensor as out to decode into it (resized to
+    fit) instead of allocating a new one.
+    """
+    sr, data = read_wav(path, start, stop)
+    return _to_float_tensor(data, max_wav_value, out), sr
+
+
+def _to_float_tensor(data, max_wav_value=None, out=None):
+    if out is None:
+        out = torch.empty(data.shape, dtype=torch.float32)
+    else:
+        out.resize_(data.shape)
+    if max_wav_value is None:
+        np.copyto(out.numpy(), data, casting="unsafe")
+    else:
+        np.multiply(
+            data, np.float32(1.0 / max_wav_value), out=out.numpy(), casting="unsafe"
+        )
+    return out
+
+
+def iter_wav_blocks(path, block_size=2 ** 20, max_wav_value=None):
+    """Yield the samples of a wav as float32 tensors of block_size samples,
+    e.g. to stream a long recording through StreamingMelSTFT."""
+    _, data = read_wav(path)
+    for start in range(0, len(data), block_size):
+        yield _to_float_tensor(data[start : start + block_size], max_wav_value)
\ No newline at end of file
@@ -1,11 +1,12 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/utils.utils.ipynb (unless otherwise specified).
 
-__all__ = ['load_filepaths_and_text', 'synthesize_speakerids2', 'parse_vctk', 'parse_libritts_mellotron',
-           'add_speakerid', 'parse_libritts_mellotron', 'parse_uberduck', 'parse_ljspeech', 'get_alignment_metrics',
-           'window_sumsquare', 'griffin_lim', 'dynamic_range_compression', 'dynamic_range_decompression', 'to_gpu',
-           'get_mask_from_lengths', 'reduce_tensor', 'subsequent_mask', 'convert_pad_shape', 'sequence_mask',
-           'generate_path', 'slice_segments', 'rand_slice_segments', 'init_weights', 'get_padding',
-           'fused_add_tanh_sigmoid_multiply', 'clip_grad_value_', 'intersperse']
+__all__ = ['ColumnarFilelist', 'load_filepaths_and_text', 'synthesize_speakerids2', 'parse_vctk',
+           'parse_libritts_mellotron', 'add_speakerid', 'parse_libritts_mellotron', 'parse_uberduck', 'parse_ljspeech',
+           'get_alignment_metrics', 'window_sumsquare', 'griffin_lim', 'dynamic_range_compression',
+           'dynamic_range_decompression', 'to_gpu', 'get_mask_from_lengths', 'reduce_tensor', 'subsequent_mask',
+           'convert_pad_shape', 'sequence_mask', 'generate_path', 'slice_segments', 'rand_slice_segments',
+           'slice_ragged_segments', 'init_weights', 'get_padding', 'fused_add_tanh_sigmoid_multiply',
+           'clip_grad_value_', 'intersperse']
 
 # Cell
 
@@ -21,9 +22,137 @@ import librosa
 from torch.nn import functional as F
 
 
-def load_filepaths_and_text(filename: str, split: str = "|"):
+def _pack_strings(strings):
+    """Pack strings into a UTF-8 byte buffer and an offsets array."""
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _take_strings(buffer, offsets, indices):
+    """Gather the packed strings at indices into a new buffer and offsets."""
+    starts = offsets[indices]
+    lengths = offsets[indices + 1] - starts
+    new_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    positions = np.arange(new_offsets[-1]) + np.repeat(
+        starts - new_offsets[:-1], lengths
+    )
+    return buffer[positions], new_offsets
+
+
+class ColumnarFilelist:
+    """A parsed filelist held as columns instead of a list of lists.
+
+    Each column is a packed UTF-8 buffer plus offsets, except the speaker id
+    column (index 2), which is an int64 array when every id is an integer.
+    With no per-row Python objects, forked DataLoader workers can read rows
+    without refcount writes, so the pages stay shared copy-on-write.
+
+    Rows are returned as lists of strings, as load_filepaths_and_text used to
+    return them.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    @classmethod
+    def from_rows(cls, rows):
+        rows = list(rows)
+        num_columns = len(rows[0]) if rows else 0
+        assert all(
+            len(row) == num_columns for row in rows
+        ), "Every filelist row needs the same number of columns"
+        columns = []
+        for i in range(num_columns):
+            values = [row[i] for row in rows]
+            if i == 2 and all(v.isdigit() and str(int(v)) == v for v in values):
+                columns.append(np.array([int(v) for v in values], dtype=np.int64))
+            else:
+                columns.append(_pack_strings(values))
+        return cls(columns)
+
+    def __len__(self):
+        if not self.columns:
+            return 0
+        column = self.columns[0]
+        return len(column) if isinstance(column, np.ndarray) else len(column[1]) - 1
+
+    def _value(self, column, idx):
+        if isinstance(column, np.ndarray):
+            return str(column[idx])
+        buffer, offsets = column
+        return buffer[offsets[idx] : offsets[idx + 1]].tobytes().decode("utf-8")
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Filelist index {idx} out of range")
+        return [self._value(column, idx) for column in self.columns]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def column(self, i):
+        """Column i as a list of strings."""
+        return [self._value(self.columns[i], idx) for idx in range(len(self))]
+
+    @property
+    def sids(self):
+        """Speaker ids as an int64 array, or None if they aren't integers."""
+        column = self.columns[2] if len(self.columns) > 2 else None
+        return column if isinstance(column, np.ndarray) else None
+
+    def char_lengths(self, i):
+        """Length in characters of every value in string column i."""
+        buffer, offsets = self.columns[i]
+        # Count the bytes that start a UTF-8 character.
+        starts = np.zeros(len(buffer) + 1, dtype=np.int64)
+        np.cumsum((buffer & 0xC0) != 0x80, out=starts[1:])
+        return starts[offsets[1:]] - starts[offsets[:-1]]
+
+    def take(self, indices):
+        """A new ColumnarFilelist with the rows at indices, in that order."""
+        indices = np.asarray(indices, dtype=np.int64)
+        columns = []
+        for column in self.columns:
+            if isinstance(column, np.ndarray):
+                columns.append(column[indices])
+            else:
+                columns.append(_take_strings(*column, indices))
+        return ColumnarFilelist(columns)
+
+    def __add__(self, other):
+        if isinstance(other, list):
+            other = ColumnarFilelist.from_rows(other)
+        if len(self.columns) != len(other.columns):
+            raise ValueError("Can't concatenate filelists with different columns")
+        columns = []
+        for a, b in zip(self.columns, other.columns):
+            if isinstance(a, np.ndarray) and isinstance(b, np.ndarray):
+                columns.append(np.concatenate([a, b]))
+                continue
+            if isinstance(a, np.ndarray):
+                a = _pack_strings([str(v) for v in a])
+            if isinstance(b, np.ndarray):
+                b = _pack_strings([str(v) for v in b])
+            columns.append(
+                (
+                    np.concatenate([a[0], b[0]]),
+                    np.concatenate([a[1], a[1][-1] + b[1][1:]]),
+                )
+            )
+        return ColumnarFilelist(columns)
+
+
+def load_filepaths_and_text(filename: str, split: str = "|", columnar: bool = False):
     with open(filename, encoding="utf-8") as f:
         filepaths_and_text = [line.strip().split(split) for line in f]
+    if columnar:
+        return ColumnarFilelist.from_rows(filepaths_and_text)
     return filepaths_and_text
 
 
@@ -270,29 +399,70 @@ def window_sumsquare(
     win_sq = librosa_util.normalize(win_sq, norm=norm) ** 2
     win_sq = librosa_util.pad_center(win_sq, n_fft)
 
-    # Fill the envelope
-    for i in range(n_frames):
-        sample = i * hop_length
-        x[sample : min(n, sample + n_fft)] += win_sq[: max(0, min(n_fft, n - sample))]
+    # Fill the envelope. Split the window into hop_length chunks: chunk j of
+    # frame i lands on hop row i + j, so each chunk is added to n_frames
+    # consecutive rows at once.
+    n_chunks = -(-n_fft // hop_length)
+    chunks = np.zeros(n_chunks * hop_length, dtype=dtype)
+    chunks[:n_fft] = win_sq
+    chunks = chunks.reshape(n_chunks, hop_length)
+    rows = np.zeros((n_frames + n_chunks - 1, hop_length), dtype=dtype)
+    for j in range(n_chunks):
+        rows[j : j + n_frames] += chunks[j]
+    x[:] = rows.reshape(-1)[:n]
     return x
 
 
-def griffin_lim(magnitudes, stft_fn, n_iters=30):
+def griffin_lim(magnitudes, stft_fn, n_iters=30, momentum=0.99, lengths=None, tol=None):
     """
     PARAMS
     ------
-    magnitudes: spectrogram magnitudes
+    magnitudes: spectrogram magnitudes, (B, n_freqs, T)
     stft_fn: STFT class with transform (STFT) and inverse (ISTFT) methods
+    momentum: fast Griffin-Lim momentum (Perraudin et al., 2013). 0 is plain Griffin-Lim.
+    lengths: number of valid frames of each spectrogram in a padded batch.
+        Frames past the length are treated as silence.
+    tol: stop early once no spectrogram's spectral convergence improved by
+        more than this fraction in an iteration.
+
+    RETURNS
+    -------
+    signal: (B, n_samples) on the device of magnitudes
     """
+    if lengths is not None:
+        mask = torch.arange(magnitudes.size(-1), device=magnitudes.device)
+        mask = mask[None] < lengths.to(magnitudes.device)[:, None]
+        magnitudes = magnitudes * mask[:, None]
+    norms = torch.linalg.vector_norm(magnitudes, dim=(1, 2)).clamp(min=1e-8)
 
-    angles = np.angle(np.exp(2j * np.pi * np.random.rand(*magnitudes.size())))
-    angles = angles.astype(np.float32)
-    angles = torch.autograd.Variable(torch.from_numpy(angles))
+    angles = 2 * np.pi * torch.rand(magnitudes.shape, device=magnitudes.device)
     signal = stft_fn.inverse(magnitudes, angles).squeeze(1)
-
+    prev_rebuilt = None
+    prev_convergence = None
     for i in range(n_iters):
-        _, angles = stft_fn.transform(signal)
-        signal = stft_fn.inverse(magnitudes, angles).squeeze(1)
+        rebuilt_magnitudes, rebuilt_angles = stft_fn.transform(signal)
+        rebuilt = torch.polar(rebuilt_magnitudes, rebuilt_angles)
+        accelerated = rebuilt
+        if momentum and prev_rebuilt is not None:
+            accelerated = rebuilt - momentum / (1 + momentum) * prev_rebuilt
+        prev_rebuilt = rebuilt
+        signal = stft_fn.inverse(magnitudes, accelerated.angle()).squeeze(1)
+        if tol is not None:
+            convergence = (
+                torch.linalg.vector_norm(rebuilt_magnitudes - magnitudes, dim=(1, 2))
+                / norms
+            )
+            if prev_convergence is not None and bool(
+                (prev_convergence - convergence <= tol * prev_convergence).all()
+            ):
+                break
+            prev_convergence = convergence
+    if lengths is not None:
+        n_samples = lengths.to(signal.device) * stft_fn.hop_length
+        signal = signal * (
+            torch.arange(signal.size(-1), device=signal.device)[None]
+            < n_samples[:, None]
+        )
     return signal
 
 
@@ -401,6 +571,20 @@ def rand_slice_segments(x, x_lengths=None, segment_size=4):
     ret = slice_segments(x, ids_str, segment_size)
     return ret, ids_str
 
+
+def slice_ragged_segments(x, x_lengths, ids_str, segment_size=4):
+    """Slice segments out of sequences concatenated into one flat tensor.
+
+    x: (sum(x_lengths),) tensor of concatenated sequences.
+    Returns a (b, 1, segment_size) tensor, zero-padded past the end of each
+    sequence like slice_segments on a zero-padded batch.
+    """
+    offsets = torch.cumsum(x_lengths, 0) - x_lengths
+    positions = ids_str[:, None] + torch.arange(segment_size, device=x.device)
+    valid = positions < x_lengths[:, None]
+    idx = (offsets[:, None] + positions).clamp(max=x.size(0) - 1)
+    return (x[idx] * valid).unsqueeze(1)
+
 # Cell
 def init_weights(m, mean=0.0, std=0.01):
     classname = m.__class__.__name__